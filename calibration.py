@@ -0,0 +1,58 @@
+import math
+
+import numpy
+
+
+def click_track(interval, beats, frequency, channels, accent=4, click_length=30):
+    """
+    16 bit samples for beats clicks interval ms apart, the first one right at the start and every accent'th one
+    higher so it's easy to keep your place. The clicks are placed to the sample, so however late the mixer
+    starts playing it, they're exactly interval apart after that
+    """
+    samples = numpy.zeros(int(math.ceil(frequency * interval * beats / 1000)), numpy.float32)
+    t = numpy.arange(int(frequency * click_length / 1000)) / frequency
+    envelope = numpy.exp(-t * 200)
+    for beat in range(beats):
+        pitch = 1760 if beat % accent == 0 else 880
+        start = int(round(beat * interval * frequency / 1000))
+        samples[start : start + len(t)] = numpy.sin(2 * math.pi * pitch * t) * envelope
+    samples = (samples * 0.6 * 32767).astype(numpy.int16)
+    return numpy.ascontiguousarray(numpy.repeat(samples[:, None], channels, axis=1))
+
+
+def estimate_offset(taps, beats, trim=0.2, min_taps=6):
+    """
+    How late taps were on average compared to the beats they were aimed at, in ms. Each tap goes with the
+    nearest beat, and only the first tap for each beat counts. Anything more than half a beat out wasn't aimed
+    at that beat at all, and anything a long way from the rest (three median absolute deviations from the
+    median) was a slip, so both get thrown away. We average what's left with the top and bottom trim of it
+    thrown away too.
+
+    Returns (offset, spread, taps used), or None if there weren't at least min_taps left to go on
+    """
+    taps = numpy.asarray(taps, numpy.float64)
+    beats = numpy.asarray(beats, numpy.float64)
+    if len(taps) == 0 or len(beats) < 2:
+        return None
+
+    right = numpy.clip(numpy.searchsorted(beats, taps), 0, len(beats) - 1)
+    left = numpy.maximum(right - 1, 0)
+    nearest = numpy.where(numpy.abs(taps - beats[left]) <= numpy.abs(taps - beats[right]), left, right)
+    # unique gives us the first index of each one, and the taps are in order
+    nearest, first = numpy.unique(nearest, return_index=True)
+    offsets = taps[first] - beats[nearest]
+    offsets = offsets[numpy.abs(offsets) < numpy.median(numpy.diff(beats)) / 2]
+    if len(offsets) < min_taps:
+        return None
+
+    median = numpy.median(offsets)
+    deviation = numpy.abs(offsets - median)
+    # Someone who's really consistent would have nearly no deviation, and then everything would be an outlier
+    limit = max(3 * 1.4826 * numpy.median(deviation), 5)
+    offsets = numpy.sort(offsets[deviation <= limit])
+    if len(offsets) < min_taps:
+        return None
+
+    cut = int(len(offsets) * trim)
+    kept = offsets[cut : len(offsets) - cut]
+    return float(kept.mean()), float(offsets.std()), len(offsets)
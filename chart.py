@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+
+import numpy
+
+# Bump this whenever the compiled format changes so that old caches get thrown away
+version = 1
+
+dtype = numpy.dtype(
+    [
+        ("time", numpy.float64),
+        ("duration", numpy.float64),
+        ("instrument", numpy.uint8),
+        ("key", numpy.uint16),
+        ("difficulty", numpy.float32),
+    ]
+)
+
+
+class Chart(object):
+    """
+    A compiled chart. The notes are a structured array sorted by time, and the instrument and key fields are
+    indices into the instruments and keys lists
+    """
+
+    def __init__(self, notes, instruments, keys):
+        self.notes = notes
+        self.instruments = instruments
+        self.keys = keys
+
+    def select(self, instruments, difficulty):
+        """The notes for any of the given instruments that are in play at the given difficulty"""
+        ids = [i for i, name in enumerate(self.instruments) if name in instruments]
+        mask = numpy.isin(self.notes["instrument"], ids) & (self.notes["difficulty"] <= difficulty)
+        return self.notes[mask]
+
+    def sections(self, gap):
+        """The times of the first note after each silence of at least gap ms, which is where sections start"""
+        times = self.notes["time"]
+        if len(times) == 0:
+            return times
+        starts = numpy.flatnonzero(numpy.diff(times) >= gap) + 1
+        return numpy.concatenate((times[:1], times[starts]))
+
+
+def compile_chart(filename):
+    """
+    Turn a chart in the text format into a Chart. Each line is "ms, duration, instrument, note, difficulty",
+    and a line of the form +n/m between two notes means they're m beats apart, and the first n beats of that
+    should be filled in with copies of the first note
+    """
+    rows = []
+    instruments = {}
+    keys = {}
+
+    interval = None
+    row = None
+    with open(filename, "r") as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if "#" in line:
+                line = line[: line.index("#")].strip()
+
+            if not line:
+                continue
+
+            if interval is None and line.startswith("+"):
+                if row is None:
+                    raise ValueError(f"{filename}:{line_number}: {line} comes before any notes to fill in from")
+                n, m = (int(v) for v in line[1:].split("/"))
+                interval = (row, n, m)
+                continue
+            ms, duration, instrument, note, difficulty = line.split(",")
+            instrument = instruments.setdefault(instrument.strip(), len(instruments))
+            key = keys.setdefault(note.strip(), len(keys))
+            row = (float(ms), float(duration), instrument, key, float(difficulty))
+            if interval:
+                start, n, m = interval
+                diff = (row[0] - start[0]) / m
+                for i in range(1, n):
+                    rows.append((start[0] + diff * i,) + start[1:])
+                interval = None
+
+            rows.append(row)
+
+    notes = numpy.array(rows, dtype=dtype)
+    notes = notes[numpy.argsort(notes["time"], kind="stable")]
+    return Chart(notes, list(instruments), list(keys))
+
+
+def file_hash(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cache_names(filename):
+    base = os.path.splitext(filename)[0] + ".chart"
+    return base + ".json", base + ".npy"
+
+
+def load(filename):
+    """
+    Load a chart, using the compiled copy next to it if it's still good. We trust the cache if the source's
+    mtime and size match what they were when it was compiled, and if they don't we check the hash before
+    going to the bother of compiling it again. The notes are memory mapped, so loading is just reading the
+    header
+    """
+    meta_name, data_name = cache_names(filename)
+    stat = os.stat(filename)
+    try:
+        with open(meta_name, "r") as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        meta = None
+
+    if meta is not None and meta.get("version") == version:
+        fresh = meta["mtime"] == stat.st_mtime_ns and meta["size"] == stat.st_size
+        if not fresh and meta["hash"] == file_hash(filename):
+            # Just touched, save ourselves hashing it next time
+            meta["mtime"], meta["size"] = stat.st_mtime_ns, stat.st_size
+            write_atomic(meta_name, lambda f: f.write(json.dumps(meta).encode("utf8")))
+            fresh = True
+        if fresh:
+            try:
+                return Chart(numpy.load(data_name, mmap_mode="r"), meta["instruments"], meta["keys"])
+            except (IOError, ValueError):
+                pass
+
+    chart = compile_chart(filename)
+    meta = {
+        "version": version,
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": file_hash(filename),
+        "instruments": chart.instruments,
+        "keys": chart.keys,
+    }
+    # The notes have to be there before the metadata that says they're good
+    if write_atomic(data_name, lambda f: numpy.save(f, chart.notes)):
+        write_atomic(meta_name, lambda f: f.write(json.dumps(meta).encode("utf8")))
+    return chart
+
+
+def write_atomic(filename, write):
+    """
+    Write a file by way of a temporary one, so nobody ever sees half of it. We might be running from
+    somewhere read only, in which case there's just no cache
+    """
+    temp_name = filename + ".tmp"
+    try:
+        with open(temp_name, "wb") as f:
+            write(f)
+        os.replace(temp_name, filename)
+    except (IOError, OSError):
+        return False
+    return True
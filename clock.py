@@ -0,0 +1,115 @@
+import time
+
+
+def now():
+    """perf_counter in ms, which is what the clock runs on"""
+    return time.perf_counter() * 1000
+
+
+class MusicClock(object):
+    """
+    Where the music is, to well under a ms. The mixer can tell us that itself, but only to the nearest audio
+    buffer (tens of ms), it jitters, and it only knows how long it's been since play was called. So instead we
+    run our own clock off perf_counter, and every time the mixer's position moves on we compare the two and
+    nudge ours towards it; a little loop filter that slews the rate to take out the difference over a while
+    (rather than jumping, so we never go backwards), and slowly learns how fast the sound card's clock really
+    runs compared to ours. If they ever get really far apart we just believe the mixer.
+
+    Nothing here talks to the mixer; whoever's playing the music calls start when it starts playing and sample
+    with where the mixer says it is. Times are all ms of music position, and perf_counter ms from now()
+    """
+
+    def __init__(self, slew=500, max_slew=0.05, drift_gain=0.25, snap=150):
+        # How long we take to get rid of a difference from the mixer, the furthest we'll slew the rate from
+        # the drift we've learned, how quickly we learn that drift, and how far out we can be before we give up
+        # and jump
+        self.slew = slew
+        self.max_slew = max_slew
+        self.drift_gain = drift_gain
+        self.snap = snap
+        self.drift = 1.0
+        self.reset_stats()
+        self.start(0)
+        self.paused = True
+
+    def reset_stats(self):
+        self.samples = 0
+        self.snaps = 0
+        self.jitter = 0
+        self.worst_error = 0
+
+    def start(self, pos, when=None):
+        """The music is at pos right now (or at when). Whatever we'd learned about the drift still holds"""
+        if when is None:
+            when = now()
+        self.base_pos = pos
+        self.base_time = when
+        self.rate = self.drift
+        self.error = 0
+        self.paused = False
+        self.last_sample = None
+        self.last_sample_time = when
+
+    def pause(self, when=None):
+        if self.paused:
+            return
+        self.start(self.pos(when), when)
+        self.paused = True
+
+    def resume(self, when=None):
+        if not self.paused:
+            return
+        self.start(self.base_pos, when)
+
+    def pos(self, when=None):
+        if self.paused:
+            return self.base_pos
+        if when is None:
+            when = now()
+        return self.base_pos + (when - self.base_time) * self.rate
+
+    def sample(self, mixer_pos, when=None):
+        """
+        The mixer says the music's at mixer_pos. It only moves on once per audio buffer and it's right just as
+        it does, so the ones in between tell us nothing new and we skip them
+        """
+        if self.paused or mixer_pos == self.last_sample:
+            return
+        if when is None:
+            when = now()
+        first = self.last_sample is None
+        self.last_sample = mixer_pos
+        elapsed = when - self.last_sample_time
+        self.last_sample_time = when
+
+        current = self.pos(when)
+        error = mixer_pos - current
+        self.samples += 1
+        self.worst_error = max(self.worst_error, abs(error))
+
+        if abs(error) > self.snap:
+            self.snaps += 1
+            self.start(mixer_pos, when)
+            self.last_sample = mixer_pos
+            return
+
+        # Any one sample is only good to a buffer or so, so we steer by the smoothed error
+        self.error += (error - self.error) * 0.05
+        self.jitter += (abs(error - self.error) - self.jitter) * 0.05
+
+        # Start again from where we are so changing the rate doesn't move us
+        self.base_pos, self.base_time = current, when
+        error = self.error
+        if not first and elapsed > 0:
+            # If we keep ending up behind then the music's running faster than we thought. This is the integral
+            # half of the loop; the gain makes it settle without overshooting
+            self.drift += error * elapsed * self.drift_gain / (self.slew * self.slew)
+            self.drift = min(max(self.drift, 1 - self.max_slew), 1 + self.max_slew)
+        slew = min(max(error / self.slew, -self.max_slew), self.max_slew)
+        self.rate = self.drift + slew
+
+    def __repr__(self):
+        return (
+            f"MusicClock(drift={(self.drift - 1) * 1e6:+.0f}ppm error={self.error:+.1f}ms "
+            f"jitter={self.jitter:.1f}ms worst={self.worst_error:.1f}ms samples={self.samples} snaps={self.snaps})"
+        )
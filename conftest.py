@@ -0,0 +1 @@
+# The modules all live at the top level and import each other that way, so the tests need it on the path too
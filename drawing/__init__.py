@@ -1,9 +1,21 @@
-from .quads import Quad, Line, NonAlignedQuad, QuadBuffer, LineBuffer, QuadBorder, ShadowQuadBuffer
+from .quads import (
+    Quad,
+    Line,
+    NonAlignedQuad,
+    QuadBuffer,
+    MotionQuadBuffer,
+    LineBuffer,
+    QuadBorder,
+    Arena,
+    ShadowQuadBuffer,
+    quad_rects,
+)
 from .opengl import (
     init,
     new_frame,
     draw_all,
     draw_all_now,
+    draw_moving,
     draw_ui,
     init_drawing,
     draw_no_texture,
@@ -16,4 +28,4 @@ from .opengl import (
     line_width,
     shake_screen,
 )
-from . import texture, opengl, sprite, cursors
+from . import texture, opengl, sprite, cursors, tweens
@@ -139,6 +139,10 @@ class ShaderLocations(object):
         self.screen_dimensions = None
         self.translation = None
         self.scale = None
+        self.tc_offset = None
+        self.music_pos = None
+        self.motion_data = None
+        self.transform_data = None
 
 
 class ShaderData(object):
@@ -152,10 +156,11 @@ class ShaderData(object):
         state.set_shader(self)
         state.update()
 
-    def load(self, name, uniforms, attributes):
+    def load(self, name, uniforms, attributes, fragment=None):
+        """Load the shaders called name, optionally sharing the fragment shader of the ones called fragment"""
         vertex_name, fragment_name = (
-            os.path.join("drawing", "shaders", "%s_%s.glsl" % (name, typeof))
-            for typeof in ("vertex", "fragment")
+            os.path.join("drawing", "shaders", "%s_%s.glsl" % (shader_name, typeof))
+            for shader_name, typeof in ((name, "vertex"), (fragment or name, "fragment"))
         )
         codes = []
         for name in vertex_name, fragment_name:
@@ -254,6 +259,8 @@ z_max = 10000
 light_shader = ShaderData()
 geom_shader = GeometryShaderData()
 default_shader = ShaderData()
+glyph_shader = ShaderData()
+motion_shader = ShaderData()
 passthrough_shader = ShaderData()
 shadow_shader = ShaderData()
 state = State(geom_shader)
@@ -271,8 +278,19 @@ def init(w, h):
 
     default_shader.load(
         "default",
-        uniforms=("tex", "translation", "scale", "screen_dimensions", "using_textures"),
-        attributes=("vertex_data", "tc_data", "colour_data"),
+        uniforms=("tex", "translation", "scale", "screen_dimensions", "using_textures", "tc_offset"),
+        attributes=("vertex_data", "tc_data", "colour_data", "transform_data"),
+    )
+    motion_shader.load(
+        "motion",
+        uniforms=("tex", "translation", "scale", "screen_dimensions", "using_textures", "music_pos"),
+        attributes=("vertex_data", "tc_data", "colour_data", "motion_data"),
+        fragment="default",
+    )
+    glyph_shader.load(
+        "glyph",
+        uniforms=("tex", "run_table", "translation", "scale", "screen_dimensions", "glyph_tc", "glyph_size"),
+        attributes=("glyph_data",),
     )
 
     glClearColor(0.0, 0.0, 0.0, 1.0)
@@ -527,18 +545,58 @@ def init_drawing():
     glUniform1i(default_shader.locations.tex, 0)
     glUniform2f(default_shader.locations.translation, 0, 0)
     glUniform2f(default_shader.locations.scale, 1, 1)
+    glUniform2f(default_shader.locations.tc_offset, 0, 0)
+    # This is what buffers without transforms get, so make sure it's the identity
+    reset_transform()
+
+    motion_shader.use()
+    glUniform3f(motion_shader.locations.screen_dimensions, globals.screen.x, globals.screen.y, z_max)
+    glUniform1i(motion_shader.locations.tex, 0)
+    glUniform1i(motion_shader.locations.using_textures, 1)
+    glUniform2f(motion_shader.locations.translation, 0, 0)
+    glUniform2f(motion_shader.locations.scale, 1, 1)
+
+    glyph_shader.use()
+    glUniform3f(glyph_shader.locations.screen_dimensions, globals.screen.x, globals.screen.y, z_max)
+    glUniform1i(glyph_shader.locations.tex, 0)
+    glUniform1i(glyph_shader.locations.run_table, 1)
+    glUniform2f(glyph_shader.locations.translation, 0, 0)
+    glUniform2f(glyph_shader.locations.scale, 1, 1)
+    default_shader.use()
+
 
+# This needs to match the size of the metrics arrays in glyph_vertex.glsl
+max_glyphs = 160
 
-def draw_all(quad_buffer, texture):
+
+def set_glyph_metrics(tc, sizes):
+    """
+    Tell the glyph shader where each glyph is in the font texture (as (left, bottom, right, top)) and how big it
+    is in pixels. Glyph runs refer to glyphs by their index in these arrays
+    """
+    if len(tc) > max_glyphs:
+        raise ValueError(f"Font has {len(tc)} glyphs but the glyph shader only has room for {max_glyphs}")
+    glyph_shader.use()
+    glUniform4fv(glyph_shader.locations.glyph_tc, len(tc), tc)
+    glUniform2fv(glyph_shader.locations.glyph_size, len(sizes), sizes)
+    default_shader.use()
+
+
+def draw_all(quad_buffer, texture, tc_offset=None):
     """
     draw a quadbuffer with with a vertex array, texture coordinate array, and a colour
-    array
+    array. tc_offset gets added to all the texture coordinates, which with a repeating texture scrolls it
     """
     # if quad_buffer.is_ui:
     #    ui_buffers.add(quad_buffer, texture)
     #    return
     # draw_all_now_normals(quad_buffer, texture, geom_shader)
+    if tc_offset is None:
+        draw_all_now(quad_buffer, texture, default_shader)
+        return
+    glUniform2f(default_shader.locations.tc_offset, tc_offset.x, tc_offset.y)
     draw_all_now(quad_buffer, texture, default_shader)
+    glUniform2f(default_shader.locations.tc_offset, 0, 0)
 
 
 def draw_all_now_normals(quad_buffer, texture, shader):
@@ -574,6 +632,7 @@ def draw_all_now_normals(quad_buffer, texture, shader):
     glDisableVertexAttribArray(shader.locations.occlude_data)
     glDisableVertexAttribArray(shader.locations.displace_data)
     glDisableVertexAttribArray(shader.locations.colour_data)
+    reset_transform()
 
 
 def draw_all_now(quad_buffer, texture, shader):
@@ -591,11 +650,141 @@ def draw_all_now(quad_buffer, texture, shader):
     glVertexAttribPointer(shader.locations.vertex_data, 3, GL_FLOAT, GL_FALSE, 0, quad_buffer.vertex_data)
     glVertexAttribPointer(shader.locations.tc_data, 2, GL_FLOAT, GL_FALSE, 0, quad_buffer.tc_data)
     glVertexAttribPointer(shader.locations.colour_data, 4, GL_FLOAT, GL_FALSE, 0, quad_buffer.colour_data)
+    transforms = quad_buffer.transform_data is not None
+    if transforms:
+        enable_transforms(quad_buffer, shader)
 
-    glDrawElements(GL_QUADS, quad_buffer.current_size, GL_UNSIGNED_INT, quad_buffer.indices)
+    for start, count in quad_buffer.visible_ranges():
+        glDrawElements(GL_QUADS, count, GL_UNSIGNED_INT, quad_buffer.indices[start : start + count])
     glDisableVertexAttribArray(shader.locations.vertex_data)
     glDisableVertexAttribArray(shader.locations.tc_data)
     glDisableVertexAttribArray(shader.locations.colour_data)
+    if transforms:
+        disable_transforms(shader)
+
+
+def enable_transforms(quad_buffer, shader):
+    glEnableVertexAttribArray(shader.locations.transform_data)
+    glVertexAttribPointer(shader.locations.transform_data, 4, GL_FLOAT, GL_FALSE, 0, quad_buffer.transform_data)
+
+
+def disable_transforms(shader):
+    glDisableVertexAttribArray(shader.locations.transform_data)
+    reset_transform()
+
+
+def reset_transform():
+    """
+    Buffers without transforms get the attribute's current value, which GL doesn't promise anything about after
+    a draw that had an array at that location. So we set it back to the identity after any of those
+    """
+    glVertexAttrib4f(default_shader.locations.transform_data, 0, 0, 0, 1)
+
+
+def draw_moving(quad_buffer, texture, music_pos):
+    """
+    Draw a MotionQuadBuffer as it should look at music_pos. Its arrays live in buffer objects on the card, and
+    the only thing we send each frame is whichever rows have been marked dirty, which most frames is none of them
+    """
+    motion_shader.use()
+    glUniform1f(motion_shader.locations.music_pos, music_pos)
+    glActiveTexture(GL_TEXTURE0)
+    glBindTexture(GL_TEXTURE_2D, texture.texture)
+
+    locations = motion_shader.locations
+    arrays = (
+        (locations.vertex_data, quad_buffer.vertex_data),
+        (locations.tc_data, quad_buffer.tc_data),
+        (locations.colour_data, quad_buffer.colour_data),
+        (locations.motion_data, quad_buffer.motion_data),
+    )
+    if quad_buffer.vbos is None:
+        quad_buffer.vbos = glGenBuffers(len(arrays))
+        for vbo, (location, data) in zip(quad_buffer.vbos, arrays):
+            glBindBuffer(GL_ARRAY_BUFFER, vbo)
+            glBufferData(GL_ARRAY_BUFFER, data.nbytes, data, GL_DYNAMIC_DRAW)
+        quad_buffer.dirty = None
+
+    for vbo, (location, data) in zip(quad_buffer.vbos, arrays):
+        glBindBuffer(GL_ARRAY_BUFFER, vbo)
+        if quad_buffer.dirty is not None:
+            low, high = quad_buffer.dirty
+            row = data.strides[0]
+            glBufferSubData(GL_ARRAY_BUFFER, low * row, (high - low) * row, data[low:high])
+        glEnableVertexAttribArray(location)
+        glVertexAttribPointer(location, data.shape[1], GL_FLOAT, GL_FALSE, 0, None)
+    quad_buffer.dirty = None
+
+    # Anything unused or disabled has all its vertices in the same place, so we can just draw the lot
+    glDrawArrays(GL_QUADS, 0, quad_buffer.current_size)
+    for location, data in arrays:
+        glDisableVertexAttribArray(location)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    default_shader.use()
+    reset_transform()
+
+
+def draw_glyph_runs(run_buffer, texture):
+    """
+    Draw all the GlyphRuns in a GlyphRunBuffer. The vertex shader does all the work of turning them into quads,
+    all we have to do is make sure it has an up to date copy of the run table
+    """
+    if run_buffer.current_size == 0:
+        return
+    glyph_shader.use()
+    glActiveTexture(GL_TEXTURE1)
+    glBindTexture(GL_TEXTURE_2D, run_buffer.table_texture)
+    run_buffer.upload()
+    glActiveTexture(GL_TEXTURE0)
+    glBindTexture(GL_TEXTURE_2D, texture.texture)
+
+    glEnableVertexAttribArray(glyph_shader.locations.glyph_data)
+    glVertexAttribPointer(glyph_shader.locations.glyph_data, 4, GL_FLOAT, GL_FALSE, 0, run_buffer.glyph_data)
+    glDrawArrays(GL_QUADS, 0, run_buffer.current_size * 4)
+    glDisableVertexAttribArray(glyph_shader.locations.glyph_data)
+    default_shader.use()
+    reset_transform()
+
+
+def draw_glyph_runs_clipped(run_buffer, texture, bl, size, offset):
+    """
+    Draw the GlyphRuns in a GlyphRunBuffer shifted by offset, but only where they land inside the rectangle at
+    bl of the given size. That's all scrolling is; the runs themselves never have to change
+    """
+    pos = state.pos
+    state.pos = pos + offset
+    glEnable(GL_SCISSOR_TEST)
+    # The scissor box is in window pixels, so it needs to follow any screen shake like everything else
+    glScissor(int(bl.x + pos.x), int(bl.y + pos.y), int(size.x), int(size.y))
+    draw_glyph_runs(run_buffer, texture)
+    glDisable(GL_SCISSOR_TEST)
+    state.pos = pos
+    default_shader.use()
+
+
+def draw_glyph_runs_to_target(target, run_buffer, texture):
+    """
+    Draw the GlyphRuns in a GlyphRunBuffer into a RenderTarget instead of the screen. Coordinates are relative to
+    the bottom left of the target, and any screen shake is ignored
+    """
+    pos = state.pos
+    state.pos = Point(0, 0)
+    target.target()
+    glViewport(0, 0, target.x, target.y)
+    glClearColor(0.0, 0.0, 0.0, 0.0)
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+    glyph_shader.use()
+    glUniform3f(glyph_shader.locations.screen_dimensions, target.x, target.y, z_max)
+    draw_glyph_runs(run_buffer, texture)
+    glyph_shader.use()
+    glUniform3f(glyph_shader.locations.screen_dimensions, globals.screen.x, globals.screen.y, z_max)
+
+    target.detarget()
+    glViewport(0, 0, globals.screen.x, globals.screen.y)
+    glClearColor(0.0, 0.0, 0.0, 1.0)
+    state.pos = pos
+    default_shader.use()
 
 
 def draw_no_texture(quad_buffer):
@@ -615,10 +804,17 @@ def draw_no_texture_now(quad_buffer, shader):
 
     glVertexAttribPointer(shader.locations.vertex_data, 3, GL_FLOAT, GL_FALSE, 0, quad_buffer.vertex_data)
     glVertexAttribPointer(shader.locations.colour_data, 4, GL_FLOAT, GL_FALSE, 0, quad_buffer.colour_data)
-    glDrawElements(quad_buffer.draw_type, quad_buffer.current_size, GL_UNSIGNED_INT, quad_buffer.indices)
+    transforms = quad_buffer.transform_data is not None
+    if transforms:
+        enable_transforms(quad_buffer, shader)
+    for start, count in quad_buffer.visible_ranges():
+        indices = quad_buffer.indices[start : start + count]
+        glDrawElements(quad_buffer.draw_type, count, GL_UNSIGNED_INT, indices)
 
     glDisableVertexAttribArray(shader.locations.vertex_data)
     glDisableVertexAttribArray(shader.locations.colour_data)
+    if transforms:
+        disable_transforms(shader)
 
 
 def line_width(width):
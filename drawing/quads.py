@@ -6,6 +6,11 @@ from drawing.opengl import GL_QUADS
 from drawing.opengl import GL_LINES
 
 
+# (angle, pivot x, pivot y, scale) that leaves a shape alone. It's also what the shader gets for buffers without
+# transforms, as that's the default value for an attribute that doesn't have an array
+identity_transform = (0, 0, 0, 1)
+
+
 class ShapeBuffer(object):
     """
     Keeps track of a potentially large number of quads that are kept in a single contiguous array for
@@ -21,12 +26,16 @@ class ShapeBuffer(object):
         self.colour_data = numpy.ones((size * self.num_points, 4),
                                       numpy.float32)  # RGBA default is white opaque
         self.indices     = numpy.zeros(size * self.num_points, numpy.uint32)
+        # Only some buffers have per shape transforms, see QuadBuffer
+        self.transform_data = None
         self.size = size
         for i in range(size * self.num_points):
             self.indices[i] = i
         self.current_size = 0
         self.max_size     = size * self.num_points
         self.vacant = set()
+        # Arenas that aren't to be drawn at the moment
+        self.hidden = {}
 
     def next(self):
         """
@@ -38,10 +47,7 @@ class ShapeBuffer(object):
         if len(self.vacant) > 0:
             # for a vacant one we blatted the indices, so we should reset those...
             out = self.vacant.pop()
-            for i in range(self.num_points):
-                self.indices[out + i] = out + i
-                for j in range(4):
-                    self.colour_data[out + i][j] = 1
+            self.reset_shape(out)
             return out
 
         out = self.current_size
@@ -53,6 +59,47 @@ class ShapeBuffer(object):
             # self.tc_data.resize    ( (self.max_size,2) )
         return out
 
+    def reserve(self, n):
+        """
+        Set aside a contiguous range of n shapes at the end of the buffer, for a UI panel or similar to allocate
+        its shapes from. The whole range can then be hidden or shown with one call
+        """
+        start = self.current_size
+        self.current_size += n * self.num_points
+        if self.current_size > self.max_size:
+            raise NotImplementedError("Buffer is full")
+        return Arena(self, start, n)
+
+    def visible_ranges(self):
+        """The (start, count) ranges of our indices that need drawing, which is everything but hidden arenas"""
+        if not self.hidden:
+            return ((0, self.current_size),)
+        ranges = []
+        pos = 0
+        for start, end in sorted(self.hidden.values()):
+            if start > pos:
+                ranges.append((pos, start - pos))
+            pos = max(pos, end)
+        if pos < self.current_size:
+            ranges.append((pos, self.current_size - pos))
+        return ranges
+
+    def reset_shape(self, index):
+        globals.damaged = True
+        for i in range(self.num_points):
+            self.indices[index + i] = index + i
+            for j in range(4):
+                self.colour_data[index + i][j] = 1
+        if self.transform_data is not None:
+            self.transform_data[index : index + self.num_points] = identity_transform
+
+    def clear_shape(self, index):
+        globals.damaged = True
+        for i in range(self.num_points):
+            self.indices[index + i] = 0
+            for j in range(3):
+                self.vertex_data[index + i][j] = 0
+
     def truncate(self, n):
         """
         All quads pointing after the truncation point are subsequently invalid, so this call is fairly dangerous.
@@ -64,6 +111,7 @@ class ShapeBuffer(object):
             self.indices[i] = i
         self.colour_data = numpy.ones((self.max_size, 4), numpy.float32)  # RGBA default is white opaque
         self.vacant = set()
+        self.hidden = {}
 
     def remove_shape(self, index):
         """A quad is no longer needed. Because it can be in the middle of our nice block and we can't be spending
@@ -73,20 +121,83 @@ class ShapeBuffer(object):
 
         """
         self.vacant.add(index)
-        for i in range(self.num_points):
-            self.indices[index + i] = 0
-            for j in range(3):
-                self.vertex_data[index + i][j] = 0
+        self.clear_shape(index)
+
+
+class Arena(object):
+    """
+    A contiguous range of a ShapeBuffer that's been reserved with ShapeBuffer.reserve. Shapes can be allocated
+    from it just like from the buffer itself, and hiding it stops the whole range being drawn without touching
+    any of the shapes in it
+    """
+
+    def __init__(self, buffer, start, size):
+        self.buffer = buffer
+        self.num_points = buffer.num_points
+        self.start = start
+        self.end = start + size * self.num_points
+        self.current_size = start
+        self.vacant = set()
+        self.hidden = False
+
+    # The buffer can swap its arrays out from under us, so always go through it
+    @property
+    def vertex_data(self):
+        return self.buffer.vertex_data
+
+    @property
+    def tc_data(self):
+        return self.buffer.tc_data
+
+    @property
+    def colour_data(self):
+        return self.buffer.colour_data
+
+    @property
+    def transform_data(self):
+        return self.buffer.transform_data
+
+    def next(self):
+        if len(self.vacant) > 0:
+            out = self.vacant.pop()
+            self.buffer.reset_shape(out)
+            return out
+        out = self.current_size
+        if out + self.num_points > self.end:
+            raise NotImplementedError("Arena is full")
+        self.current_size += self.num_points
+        return out
+
+    def remove_shape(self, index):
+        self.vacant.add(index)
+        self.buffer.clear_shape(index)
+
+    def hide(self):
+        globals.damaged = True
+        self.hidden = True
+        self.buffer.hidden[self] = (self.start, self.end)
+
+    def show(self):
+        globals.damaged = True
+        self.hidden = False
+        self.buffer.hidden.pop(self, None)
 
 
 class QuadBuffer(ShapeBuffer):
     num_points = 4
     draw_type = drawing.opengl.GL_QUADS
 
-    def __init__(self, size, ui=False, mouse_relative=False):
+    def __init__(self, size, ui=False, mouse_relative=False, transforms=False):
+        """
+        With transforms every vertex also gets (angle, pivot x, pivot y, scale), which the shader uses to spin and
+        scale each quad about its pivot without us having to touch its vertices. See Shape.set_transform
+        """
         self.is_ui = ui
         self.mouse_relative = mouse_relative
         super(QuadBuffer, self).__init__(size)
+        if transforms:
+            self.transform_data = numpy.zeros((size * self.num_points, 4), numpy.float32)
+            self.transform_data[:] = identity_transform
 
     def sort_for_depth(self):
         depths = [(i, min(self.vertex_data[self.indices[i + j]][1] for j in range(4)))
@@ -106,6 +217,31 @@ class QuadBuffer(ShapeBuffer):
         self.indices = new_indices
 
 
+class MotionQuadBuffer(QuadBuffer):
+    """
+    A QuadBuffer for things that slide along in a straight line at a steady speed. As well as the usual arrays,
+    every vertex has (start time, velocity x, velocity y, 0) in motion_data, and the motion shader draws it at
+    vertex + velocity * (music_pos - start time). So something only needs writing when it starts moving.
+
+    The arrays are kept on the graphics card and we only send the rows that have changed since the last draw,
+    which means whoever changes anything in here has to call mark_dirty for it
+    """
+
+    def __init__(self, size):
+        super(MotionQuadBuffer, self).__init__(size)
+        self.motion_data = numpy.zeros((size * self.num_points, 4), numpy.float32)
+        self.vbos = None
+        self.dirty = (0, len(self.vertex_data))
+
+    def mark_dirty(self, start, end):
+        """Rows start to end (in vertices) need sending again"""
+        globals.damaged = True
+        if self.dirty is None:
+            self.dirty = (start, end)
+        else:
+            self.dirty = (min(self.dirty[0], start), max(self.dirty[1], end))
+
+
 class ShadowQuadBuffer(QuadBuffer):
     def new_light(self):
         row = self.current_size // self.num_points
@@ -142,6 +278,7 @@ class ShapeVertex(object):
         return self.buffer[self.index + i]
 
     def __setitem__(self, i, value):
+        globals.damaged = True
         if isinstance(i, slice):
             start, stop, stride = i.indices(len(self.buffer) - self.index)
             self.buffer[self.index + start:self.index + stop:stride] = value
@@ -227,7 +364,34 @@ class Shape(object):
     def get_centre(self):
         return (Point(self.vertex[0][0], self.vertex[0][1]) + Point(self.vertex[2][0], self.vertex[2][1])) / 2
 
+    def set_transform(self, angle=0, scale=1, pivot=None):
+        """
+        Rotate by angle radians and scale by scale about pivot, which is the middle of the shape if it isn't
+        given. The shader does this, so the vertices are left as they are and spinning or pulsing something is
+        just a few numbers. Needs a buffer made with transforms=True
+        """
+        if self.deleted:
+            return
+        if pivot is None:
+            pivot = self.get_centre()
+        globals.damaged = True
+        self.source.transform_data[self.index : self.index + self.num_points] = (angle, pivot.x, pivot.y, scale)
+
+    def set_angle(self, angle):
+        """Change just the angle, keeping the pivot and scale from set_transform"""
+        if self.deleted:
+            return
+        globals.damaged = True
+        self.source.transform_data[self.index : self.index + self.num_points, 0] = angle
+
+    def set_scale(self, scale):
+        if self.deleted:
+            return
+        globals.damaged = True
+        self.source.transform_data[self.index : self.index + self.num_points, 3] = scale
+
     def translate(self, amount):
+        globals.damaged = True
         if self.old_vertices is not None:
             vertices = self.old_vertices
         else:
@@ -239,11 +403,14 @@ class Shape(object):
     def set_colour(self, colour):
         if self.deleted:
             return
+        # setcolour writes straight into the rows, so nothing else is going to tell the main loop
         self.setcolour(self.colour, colour)
+        globals.damaged = True
 
     def set_colours(self, colours):
         if self.deleted:
             return
+        globals.damaged = True
         for current, target in zip(self.colour, colours):
             for i in range(self.num_points):
                 current[i] = target[i]
@@ -299,6 +466,22 @@ def setcoloursline(self, colour, values):
             colour[i][j] = values[i][j]
 
 
+def quad_rects(bl, tr, z):
+    """
+    The vertices for a load of axis aligned quads, in the same order set_vertices uses. bl and tr are arrays of
+    shape (n, 2) and z is either a single depth or one per quad. Returns an array of shape (n, 4, 3)
+    """
+    rects = numpy.empty((len(bl), 4, 3), numpy.float32)
+    rects[:, 0, :2] = bl
+    rects[:, 1, 0] = bl[:, 0]
+    rects[:, 1, 1] = tr[:, 1]
+    rects[:, 2, :2] = tr
+    rects[:, 3, 0] = tr[:, 0]
+    rects[:, 3, 1] = bl[:, 1]
+    rects[:, :, 2] = numpy.reshape(z, (-1, 1))
+    return rects
+
+
 class Quad(Shape):
     num_points = 4
     setvertices = setverticesquad
@@ -3,19 +3,28 @@
 uniform vec3 screen_dimensions;
 uniform vec2 translation;
 uniform vec2 scale;
+uniform vec2 tc_offset;
 in vec3 vertex_data;
 in vec2 tc_data;
 in vec4 colour_data;
+// (angle, pivot x, pivot y, scale). Buffers without transforms leave this as (0, 0, 0, 1), which does nothing
+in vec4 transform_data;
 
 out vec2 texcoord;
 out vec4 colour;
 
 void main()
 {
-    gl_Position = vec4( (((vertex_data.x+translation.x)*2*scale.x)/screen_dimensions.x)-1,
-                        (((vertex_data.y+translation.y)*2*scale.y)/screen_dimensions.y)-1,
+    vec2 pivot = transform_data.yz;
+    vec2 offset = (vertex_data.xy - pivot) * transform_data.w;
+    float c = cos(transform_data.x);
+    float s = sin(transform_data.x);
+    vec2 pos = pivot + vec2(c * offset.x - s * offset.y, s * offset.x + c * offset.y);
+
+    gl_Position = vec4( (((pos.x+translation.x)*2*scale.x)/screen_dimensions.x)-1,
+                        (((pos.y+translation.y)*2*scale.y)/screen_dimensions.y)-1,
                         -vertex_data.z/screen_dimensions.z,
                         1.0) ;
-    texcoord    = tc_data;
+    texcoord    = tc_data + tc_offset;
     colour      = colour_data;
 }
@@ -0,0 +1,15 @@
+#version 130
+
+uniform sampler2D tex;
+in vec2 texcoord;
+in vec4 colour;
+
+out vec4 out_colour;
+
+void main()
+{
+    out_colour = texture(tex, texcoord)*colour;
+    if(out_colour.a == 0) {
+        discard;
+    }
+}
@@ -0,0 +1,32 @@
+#version 130
+
+uniform vec3 screen_dimensions;
+uniform vec2 translation;
+uniform vec2 scale;
+uniform sampler2D run_table;
+uniform vec4 glyph_tc[160];
+uniform vec2 glyph_size[160];
+in vec4 glyph_data;
+
+out vec2 texcoord;
+out vec4 colour;
+
+void main()
+{
+    int glyph = int(glyph_data.z);
+    int run = int(glyph_data.w);
+    // (origin.x, origin.y, z, scale) then the colour
+    vec4 placement = texelFetch(run_table, ivec2(0, run), 0);
+    colour = texelFetch(run_table, ivec2(1, run), 0);
+
+    // Corners go bottom left, top left, top right, bottom right, the same as the quad buffers
+    int corner = gl_VertexID & 3;
+    vec2 along = vec2(corner >= 2 ? 1.0 : 0.0, (corner == 1 || corner == 2) ? 1.0 : 0.0);
+    vec2 pos = placement.xy + (glyph_data.xy + along * glyph_size[glyph]) * placement.w;
+
+    gl_Position = vec4( (((pos.x+translation.x)*2*scale.x)/screen_dimensions.x)-1,
+                        (((pos.y+translation.y)*2*scale.y)/screen_dimensions.y)-1,
+                        -placement.z/screen_dimensions.z,
+                        1.0) ;
+    texcoord    = mix(glyph_tc[glyph].xy, glyph_tc[glyph].zw, along);
+}
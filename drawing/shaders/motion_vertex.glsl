@@ -0,0 +1,26 @@
+#version 130
+
+uniform vec3 screen_dimensions;
+uniform vec2 translation;
+uniform vec2 scale;
+uniform float music_pos;
+in vec3 vertex_data;
+in vec2 tc_data;
+in vec4 colour_data;
+// (start time, velocity x, velocity y, unused). vertex_data is where we are at the start time
+in vec4 motion_data;
+
+out vec2 texcoord;
+out vec4 colour;
+
+void main()
+{
+    vec2 pos = vertex_data.xy + motion_data.yz * (music_pos - motion_data.x);
+
+    gl_Position = vec4( (((pos.x+translation.x)*2*scale.x)/screen_dimensions.x)-1,
+                        (((pos.y+translation.y)*2*scale.y)/screen_dimensions.y)-1,
+                        -vertex_data.z/screen_dimensions.z,
+                        1.0) ;
+    texcoord    = tc_data;
+    colour      = colour_data;
+}
@@ -2,6 +2,9 @@ import pygame
 import os
 import numpy
 import glob
+import collections
+import bisect
+import math
 from pygame.locals import *
 from OpenGL.GL import *
 from OpenGL.GL.framebufferobjects import *
@@ -76,6 +79,13 @@ class Texture(object):
                 t = None
             setattr(self, name, t)
 
+    def set_repeat(self):
+        """Wrap texture coordinates outside 0 to 1 around, so that scrolling the coordinates scrolls the image"""
+        for image in self.textures:
+            glBindTexture(GL_TEXTURE_2D, image.texture)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+
 
 class RenderTarget(object):
     """
@@ -119,6 +129,11 @@ class RenderTarget(object):
     def detarget(self):
         glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
 
+    def delete(self):
+        glDeleteFramebuffers(1, [self.fbo])
+        glDeleteRenderbuffers(1, [self.depthbuffer])
+        glDeleteTextures([self.texture])
+
 
 # texture atlas code taken from
 # http://omnisaurusgames.com/2011/06/texture-atlas-generation-using-python/
@@ -148,6 +163,8 @@ class TextureAtlas(object):
 
         self.texture = Texture(image_filename, *extra_names)
         self.subimages = {}
+        # Only gets filled in if someone adds images to us after loading
+        self.surface = None
         data_filename = os.path.join(globals.dirs.resource, data_filename)
         with open(data_filename, "r") as f:
             for line in f:
@@ -168,6 +185,72 @@ class TextureAtlas(object):
         name = "_".join(name.split("/"))
         return self.subimages[name]
 
+    def surface_rect(self, name):
+        """Where a subimage is in the atlas image as pygame loads it, which has 0,0 in the top left"""
+        subimage = self.subimage(name)
+        x = int(round(subimage.pos.x * self.texture.width))
+        y = int(round(subimage.pos.y * self.texture.height))
+        return pygame.Rect(x, self.texture.height - y - subimage.size.y, subimage.size.x, subimage.size.y)
+
+    def add_images(self, images):
+        """
+        Add some more images (a dict of name to pygame surface) to the atlas after it's been loaded. They get
+        packed in rows along the top of the atlas image, which grows taller to make room, and then the whole
+        texture is uploaded again. That squashes all the texture coordinates, so any that were handed out
+        before this are wrong; do it before anyone asks for them
+        """
+        if not images:
+            return
+        filename = os.path.join(globals.dirs.resource, self.texture.filenames[0])
+        old = self.surface
+        if old is None:
+            with open(filename, "rb") as f:
+                old = pygame.image.load(f)
+        width, old_height = old.get_size()
+
+        placements = []
+        x = top = row_height = 0
+        for name, image in images.items():
+            w, h = image.get_size()
+            if x + w > width:
+                x = 0
+                top += row_height
+                row_height = 0
+            placements.append((name, image, x, top))
+            x += w
+            row_height = max(row_height, h)
+        height = old_height + top + row_height
+
+        # The texture is upside down compared to pygame, so putting the new ones at the top means everything
+        # that's already there keeps its pixel coordinates
+        self.surface = pygame.Surface((width, height), pygame.SRCALPHA)
+        self.surface.blit(old, (0, height - old_height))
+        for subimage in self.subimages.values():
+            subimage.pos = Point(subimage.pos.x, subimage.pos.y * old_height / height)
+        for name, image, x, top in placements:
+            self.surface.blit(image, (x, top))
+            w, h = image.get_size()
+            self.subimages["_".join(name.split("/"))] = SubImage(
+                Point(float(x) / width, float(height - top - h) / height), Point(w, h)
+            )
+
+        image = self.texture.textures[0]
+        glBindTexture(GL_TEXTURE_2D, image.texture)
+        glTexImage2D(
+            GL_TEXTURE_2D,
+            0,
+            GL_RGBA,
+            width,
+            height,
+            0,
+            GL_RGBA,
+            GL_UNSIGNED_BYTE,
+            pygame.image.tostring(self.surface, "RGBA", 1),
+        )
+        image.width = self.texture.width = width
+        image.height = self.texture.height = height
+        cache[filename] = (image.texture, width, height)
+
     def transform_coord(self, subimage, value):
         value[0] = subimage.pos.x + value[0] * (float(subimage.size.x) / self.texture.width)
         value[1] = subimage.pos.y + value[1] * (float(subimage.size.y) / self.texture.height)
@@ -237,12 +320,441 @@ class TextAlignments:
     JUSTIFIED = 4
 
 
+class TextLayout(object):
+    """
+    Where every glyph of a string goes when it's wrapped into a box of a given size. Everything is in pixels
+    relative to the bottom left of the box, so moving the box doesn't need a new layout, just an offset.
+
+    The layout is done in one pass: the glyph advances are turned into prefix sums so that the end of each
+    line can be found with a binary search, and the places we're allowed to break (whitespace) are worked out
+    up front so that we never have to scan backwards through the text looking for the start of a word.
+    """
+
+    whitespace = " \t"
+    row_spacing = 1.2
+
+    def __init__(self, text, advances, heights, row_height, box_size, margin, alignment):
+        n = len(text)
+        self.lines = []
+        self.bl = numpy.zeros((n, 2), numpy.float32)
+        self.tr = numpy.zeros((n, 2), numpy.float32)
+        # Whitespace that we broke a line on doesn't get drawn anywhere
+        self.drawn = numpy.zeros(n, bool)
+        self.row_y = numpy.zeros(0)
+        self.size = Point(0, 0)
+        self.lowest_y = 0
+        if n == 0:
+            return
+
+        margin = Point(margin.x * box_size.x, margin.y * box_size.y)
+        # The 1.001 is a bit of slack so that text that was sized to fit exactly doesn't wrap due to rounding
+        limit = (box_size.x - margin.x) * 1.001 - margin.x
+        inner_width = box_size.x - margin.x * 2
+
+        index = numpy.arange(n)
+        space = numpy.fromiter((char in self.whitespace for char in text), bool, n)
+        prefix = numpy.zeros(n + 1, numpy.float64)
+        numpy.cumsum(advances, out=prefix[1:])
+        # For any glyph, where is the last whitespace at or before it, the last non-whitespace at or before it,
+        # and the first non-whitespace at or after it?
+        last_space = numpy.maximum.accumulate(numpy.where(space, index, -1))
+        last_glyph = numpy.maximum.accumulate(numpy.where(space, -1, index))
+        next_glyph = numpy.append(numpy.minimum.accumulate(numpy.where(space, n, index)[::-1])[::-1], n)
+
+        lines = self.lines
+        start = 0
+        while start < n:
+            end = int(numpy.searchsorted(prefix, prefix[start] + limit, side="right")) - 1
+            if end >= n:
+                lines.append((start, n))
+                break
+            if space[end]:
+                # We ran out of room on some whitespace, so it's fine to start a new line after it
+                lines.append((start, end))
+                start = int(next_glyph[end])
+                continue
+            split = int(last_space[end])
+            if split > start:
+                # We're in the middle of a word so the line ends at the whitespace before it
+                lines.append((start, split))
+                start = int(next_glyph[split])
+            else:
+                # This single word is too big for the line, so it'll just have to be broken where it is
+                end = max(end, start + 1)
+                lines.append((start, end))
+                start = end
+
+        starts = numpy.array([line[0] for line in lines])
+        ends = numpy.array([line[1] for line in lines])
+        # Trailing whitespace doesn't count when we're working out how wide a line is
+        content_ends = numpy.maximum(last_glyph[ends - 1] + 1, starts)
+        widths = prefix[content_ends] - prefix[starts]
+        slack = numpy.maximum(inner_width - widths, 0)
+
+        spaces_before = numpy.zeros(n + 1, numpy.int64)
+        numpy.cumsum(space, out=spaces_before[1:])
+        extra = numpy.zeros(len(lines))
+        if alignment == TextAlignments.CENTRE:
+            offsets = slack / 2
+        elif alignment == TextAlignments.RIGHT:
+            offsets = slack
+        else:
+            offsets = numpy.zeros(len(lines))
+            if alignment == TextAlignments.JUSTIFIED and len(lines) > 1:
+                # Spread each line out across the gaps between its words, apart from the last line which we
+                # leave alone like everyone else does
+                gaps = spaces_before[content_ends[:-1]] - spaces_before[starts[:-1]]
+                extra[:-1] = numpy.where(gaps > 0, slack[:-1] / numpy.maximum(gaps, 1), 0)
+
+        line_of = numpy.searchsorted(starts, index, side="right") - 1
+        self.drawn = index < ends[line_of]
+        line_start = starts[line_of]
+        x = (
+            margin.x
+            + prefix[:-1]
+            - prefix[line_start]
+            + offsets[line_of]
+            + (spaces_before[:-1] - spaces_before[line_start]) * extra[line_of]
+        )
+        row_y = box_size.y - margin.y - row_height - numpy.arange(len(lines)) * row_height * self.row_spacing
+        y = row_y[line_of]
+
+        self.bl[:, 0] = x
+        self.bl[:, 1] = y
+        self.tr[:, 0] = x + advances
+        self.tr[:, 1] = y + heights
+        self.bl[~self.drawn] = 0
+        self.tr[~self.drawn] = 0
+        self.row_y = row_y
+        self.size = Point(float(widths.max()), float(row_height + row_y[0] - row_y[-1]))
+        self.lowest_y = float(row_y[-1]) / box_size.y
+        for array in self.bl, self.tr, self.drawn:
+            array.flags.writeable = False
+
+    @property
+    def nbytes(self):
+        return self.bl.nbytes + self.tr.nbytes + self.drawn.nbytes + self.row_y.nbytes + len(self.lines) * 64
+
+
+class GlyphRun(object):
+    """
+    A string drawn by a GlyphRunBuffer. All we keep for it is a compact array of glyph indices and their offsets
+    from the origin (in unscaled font pixels), plus a single record of origin, depth, scale and colour that the
+    vertex shader uses to place the whole lot. Moving, scaling, recolouring or hiding the string only touches
+    that record, and changing the text is a few numpy slice writes regardless of how long it is.
+    """
+
+    def __init__(self, source, slot):
+        self.source = source
+        self.slot = slot
+        self.start = None
+        self.capacity = 0
+        self.length = 0
+        self.scale = 1
+        self.enabled = True
+        self.deleted = False
+
+    def set_glyphs(self, glyphs, offsets):
+        """glyphs is an array of glyph indices from the TextManager and offsets is a matching (n, 2) array"""
+        if self.deleted:
+            return
+        n = len(glyphs)
+        if n > self.capacity:
+            if self.start is not None:
+                self.source.release(self.start, self.capacity)
+            self.start = self.source.allocate(n)
+            self.capacity = n
+        self.length = n
+        globals.damaged = True
+        if self.start is None:
+            return
+        data = self.source.glyph_data[self.start * 4 : (self.start + n) * 4].reshape(n, 4, 4)
+        data[:, :, 0:2] = numpy.reshape(offsets, (n, 1, 2))
+        data[:, :, 2] = numpy.reshape(glyphs, (n, 1))
+        data[:, :, 3] = self.slot
+        # Anything left over from a longer string we used to have belongs to the hidden run
+        self.source.glyph_data[(self.start + n) * 4 : (self.start + self.capacity) * 4] = 0
+
+    def set_placement(self, origin, z, scale):
+        if self.deleted:
+            return
+        self.scale = scale
+        self.source.set_record(self.slot, 0, (origin.x, origin.y, z, scale if self.enabled else 0))
+
+    def set_colour(self, colour):
+        if self.deleted:
+            return
+        self.source.set_record(self.slot, 1, colour)
+
+    def disable(self):
+        if self.deleted or not self.enabled:
+            return
+        self.enabled = False
+        self.source.set_record(self.slot, 0, 0, 3)
+
+    def enable(self):
+        if self.deleted or self.enabled:
+            return
+        self.enabled = True
+        self.source.set_record(self.slot, 0, self.scale, 3)
+
+    def delete(self):
+        if self.deleted:
+            return
+        if self.start is not None:
+            self.source.release(self.start, self.capacity)
+        self.source.release_run(self.slot)
+        self.deleted = True
+
+
+class GlyphRunBuffer(object):
+    """
+    Storage for a bunch of GlyphRuns that get drawn in a single call. Each glyph gets four vertices of
+    (offset x, offset y, glyph index, run slot); which corner of the glyph a vertex is comes from its position in
+    the array, and everything else is looked up in the shader from the font metrics uniforms and the run table,
+    which is a small float texture with two texels (placement and colour) per run.
+
+    Run slot 0 is never handed out and has a scale of zero, so any glyph pointing at it is invisible. That's
+    what we point freed glyphs at rather than compacting the array.
+    """
+
+    def __init__(self, size=4096, runs=1024):
+        self.glyph_data = numpy.zeros((size * 4, 4), numpy.float32)
+        self.size = size
+        self.current_size = 0
+        self.free = []
+        self.run_data = numpy.zeros((runs, 2, 4), numpy.float32)
+        self.run_data[:, 1] = 1  # default colour is white opaque
+        self.vacant_runs = list(range(runs - 1, 0, -1))
+        self.dirty = (0, runs)
+        self.hidden = False
+        self.table_texture = glGenTextures(1)
+        self.allocate_table()
+
+    def allocate_table(self):
+        glBindTexture(GL_TEXTURE_2D, self.table_texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexImage2D(
+            GL_TEXTURE_2D, 0, GL_RGBA32F, 2, len(self.run_data), 0, GL_RGBA, GL_FLOAT, self.run_data
+        )
+        self.dirty = None
+
+    def new_run(self):
+        if not self.vacant_runs:
+            # Double the run table. The old slots stay where they are so nothing needs to know
+            old = len(self.run_data)
+            self.run_data = numpy.concatenate((self.run_data, numpy.zeros_like(self.run_data)))
+            self.run_data[old:, 1] = 1
+            self.vacant_runs = list(range(len(self.run_data) - 1, old - 1, -1))
+            self.allocate_table()
+        return GlyphRun(self, self.vacant_runs.pop())
+
+    def release_run(self, slot):
+        self.run_data[slot, 0] = 0
+        self.run_data[slot, 1] = 1
+        self.mark_dirty(slot)
+        self.vacant_runs.append(slot)
+
+    def set_record(self, slot, row, value, column=None):
+        if column is None:
+            self.run_data[slot, row] = value
+        else:
+            self.run_data[slot, row, column] = value
+        self.mark_dirty(slot)
+
+    def mark_dirty(self, slot):
+        globals.damaged = True
+        if self.dirty is None:
+            self.dirty = (slot, slot + 1)
+        else:
+            self.dirty = (min(self.dirty[0], slot), max(self.dirty[1], slot + 1))
+
+    def upload(self):
+        """Send any run records that have changed to the run table. Expects the table to be bound"""
+        if self.dirty is None:
+            return
+        low, high = self.dirty
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, low, 2, high - low, GL_RGBA, GL_FLOAT, self.run_data[low:high])
+        self.dirty = None
+
+    def allocate(self, n):
+        """Find room for n glyphs, preferring gaps left by deleted runs, and return the first glyph index"""
+        for i, (start, length) in enumerate(self.free):
+            if length >= n:
+                if length == n:
+                    del self.free[i]
+                else:
+                    self.free[i] = (start + n, length - n)
+                return start
+
+        start = self.current_size
+        self.current_size += n
+        if self.current_size > self.size:
+            while self.current_size > self.size:
+                self.size *= 2
+            glyph_data = numpy.zeros((self.size * 4, 4), numpy.float32)
+            glyph_data[: len(self.glyph_data)] = self.glyph_data
+            self.glyph_data = glyph_data
+        return start
+
+    def release(self, start, n):
+        if n == 0:
+            return
+        globals.damaged = True
+        self.glyph_data[start * 4 : (start + n) * 4] = 0
+        i = bisect.bisect(self.free, (start, n))
+        # Merge with the neighbouring gaps so the free list doesn't fill up with slivers
+        if i < len(self.free) and self.free[i][0] == start + n:
+            n += self.free.pop(i)[1]
+        if i > 0 and self.free[i - 1][0] + self.free[i - 1][1] == start:
+            i -= 1
+            start, n = self.free[i][0], self.free[i][1] + n
+            del self.free[i]
+        if start + n == self.current_size:
+            self.current_size = start
+        else:
+            self.free.insert(i, (start, n))
+
+    def delete(self):
+        glDeleteTextures([self.table_texture])
+
+
+class LayoutCache(object):
+    """
+    Least recently used cache of text measurements and layouts. The same handful of strings ("Play",
+    "Restart", the difficulty names and so on) get measured and laid out over and over, and a layout doesn't
+    depend on where the box is, so we can keep them around and just offset them into place.
+
+    It's capped by an estimate of how much memory the cached entries are using rather than by a count, since
+    the layout of a page of help text is a lot bigger than the size of the word "Quit".
+    """
+
+    entry_overhead = 256
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, make):
+        """Return the entry for key, calling make() to create it if we don't have it"""
+        try:
+            value, size = self.entries[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+        value = make()
+        size = self.entry_overhead + len(key[1]) + getattr(value, "nbytes", 0)
+        self.entries[key] = (value, size)
+        self.bytes += size
+        # Always keep the one we just made, even if it's bigger than the whole cache on its own
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, (old_value, old_size) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        rate = (100.0 * self.hits / total) if total else 0
+        return (
+            f"LayoutCache: {len(self.entries)} entries, {self.bytes}/{self.max_bytes} bytes, "
+            f"{self.hits} hits {self.misses} misses ({rate:.1f}%)"
+        )
+
+
+class TextSprite(object):
+    """
+    A string that has been drawn once into its own texture, so that it can be shown with a single quad. Get
+    them from TextManager.sprite and call release when you're done so the cache knows it can throw it away.
+    The texture is the target, which can be passed to anything that draws with a texture
+    """
+
+    def __init__(self, key, text, scale, size):
+        self.key = key
+        self.text = text
+        self.scale = scale
+        self.size = size
+        self.target = RenderTarget(size.x, size.y, globals.screen)
+        # Colour and depth buffers are both 4 bytes a pixel
+        self.nbytes = size.x * size.y * 8
+        self.users = 0
+
+    def release(self):
+        self.users -= 1
+
+    def delete(self):
+        self.target.delete()
+
+
+class TextSpriteCache(object):
+    """
+    Least recently used cache of TextSprites, capped by how much video memory their textures use. Sprites that
+    someone is still using are never thrown out, even if that puts us over budget for a while
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.sprites = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, make):
+        try:
+            sprite = self.sprites[key]
+        except KeyError:
+            self.misses += 1
+            sprite = make()
+            self.sprites[key] = sprite
+            self.bytes += sprite.nbytes
+            self.evict()
+        else:
+            self.hits += 1
+            self.sprites.move_to_end(key)
+        sprite.users += 1
+        return sprite
+
+    def evict(self):
+        for key, sprite in list(self.sprites.items()):
+            if self.bytes <= self.max_bytes:
+                break
+            if sprite.users > 0:
+                continue
+            del self.sprites[key]
+            self.bytes -= sprite.nbytes
+            sprite.delete()
+
+    def __repr__(self):
+        return (
+            f"TextSpriteCache: {len(self.sprites)} sprites, {self.bytes}/{self.max_bytes} bytes, "
+            f"{self.hits} hits {self.misses} misses"
+        )
+
+
 class TextManager(object):
+    layout_cache_bytes = 4 * 1024 * 1024
+    sprite_cache_bytes = 16 * 1024 * 1024
+
     def __init__(self):
         # fontname,fontdataname = (os.path.join('fonts',name) for name in ('pixelmix.png','pixelmix.txt'))
         # self.atlas = TextureAtlas(fontname,fontdataname)
         self.atlas = PetsciiAtlas(os.path.join("fonts", "petscii.png"))
         self.font_height = max(subimage.size.y for subimage in self.atlas.subimages.values())
+        self.glyph_sizes = {
+            char: (subimage.size.x, subimage.size.y) for char, subimage in self.atlas.subimages.items()
+        }
+        self.layout_cache = LayoutCache(self.layout_cache_bytes)
         # these are reclaimed when out of use so this means 131072 concurrent chars
         self.quads = quads.QuadBuffer(131072, ui=True)
         TextTypes.BUFFER = {
@@ -250,6 +762,21 @@ class TextManager(object):
             TextTypes.GRID_RELATIVE: globals.nonstatic_text_buffer,
             TextTypes.MOUSE_RELATIVE: globals.mouse_relative_text,
         }
+        # Text boxes don't use a quad per letter, they get a glyph run in here, which needs the font metrics
+        # handing to the shader
+        self.runs = GlyphRunBuffer()
+        # Extra buffers that we draw for UI panels, so they can hide all their text at once
+        self.panel_runs = []
+        # Somewhere to put strings while we draw them into a TextSprite
+        self.sprite_runs = GlyphRunBuffer(size=256, runs=2)
+        self.sprites = TextSpriteCache(self.sprite_cache_bytes)
+        names = sorted(self.atlas.subimages)
+        self.glyph_index = {name: i for i, name in enumerate(names)}
+        tc = numpy.array([self.atlas.texture_coords(name) for name in names], numpy.float32)
+        opengl.set_glyph_metrics(
+            numpy.ascontiguousarray(numpy.concatenate((tc[:, 0], tc[:, 2]), axis=1)),
+            numpy.array([self.glyph_sizes[name] for name in names], numpy.float32),
+        )
 
     def letter(self, char, textType, userBuffer=None):
         """Given a character, return a quad with the corresponding letter on it in this textManager's font"""
@@ -260,17 +787,91 @@ class TextManager(object):
         quad.letter = char
         return quad
 
+    def new_run(self, text_type=TextTypes.SCREEN_RELATIVE, user_buffer=None):
+        """
+        Get a GlyphRun to draw a string with. If the caller gives us a GlyphRunBuffer it goes in there, which for
+        CUSTOM text means it's up to them to draw it. Everything else we draw ourselves
+        """
+        return (user_buffer if user_buffer is not None else self.runs).new_run()
+
+    def new_panel_runs(self, runs):
+        """A GlyphRunBuffer that we'll draw along with our own unless it's hidden"""
+        buffer = GlyphRunBuffer(size=1024, runs=runs)
+        self.panel_runs.append(buffer)
+        return buffer
+
+    def glyphs(self, text):
+        """The glyph indices for a string, as used by GlyphRun.set_glyphs"""
+        return numpy.fromiter((self.glyph_index[char] for char in text), numpy.float32, len(text))
+
+    def sprite(self, text, scale):
+        """
+        Get a TextSprite with the text drawn on a single row at the given scale. It's cached, so asking for the
+        same thing again is cheap, but remember to release it when you're finished with it
+        """
+        key = (text, scale, self.atlas.texture.texture)
+        return self.sprites.get(key, lambda: self.make_sprite(key, text, scale))
+
+    def make_sprite(self, key, text, scale):
+        width, height = self.get_size(text, scale)
+        sprite = TextSprite(key, text, scale, Point(max(int(math.ceil(width)), 1), max(int(math.ceil(height)), 1)))
+        advances = numpy.array([self.glyph_sizes[char][0] for char in text], numpy.float32)
+        offsets = numpy.zeros((len(text), 2), numpy.float32)
+        offsets[1:, 0] = numpy.cumsum(advances)[:-1]
+
+        run = self.sprite_runs.new_run()
+        run.set_glyphs(self.glyphs(text), offsets)
+        run.set_placement(Point(0, 0), TextTypes.LEVELS[TextTypes.SCREEN_RELATIVE], scale * global_scale)
+        opengl.draw_glyph_runs_to_target(sprite.target, self.sprite_runs, self.atlas.texture)
+        run.delete()
+        return sprite
+
     def get_size(self, text, scale):
         """
         How big would the text be if drawn on a single row in the given size?
         """
-        sizes = [self.atlas.subimage(char).size * scale * global_scale for char in text]
-        out = Point(sum(item.x for item in sizes), max(item.y for item in sizes))
-        return out
+        width, height = self.layout_cache.get(("size", text, scale), lambda: self.measure(text, scale))
+        return Point(width, height)
+
+    def measure(self, text, scale):
+        sizes = [self.glyph_sizes[char] for char in text]
+        glyph_scale = scale * global_scale
+        return sum(size[0] for size in sizes) * glyph_scale, max(size[1] for size in sizes) * glyph_scale
+
+    def layout(self, text, scale, box_size, margin, alignment):
+        """
+        Work out where all the glyphs of text go when it's wrapped into a box of box_size pixels with the
+        given (box relative) margin. The result is shared with anyone else who asks for the same thing, so
+        don't modify it
+        """
+        key = (
+            "layout",
+            text,
+            scale,
+            (float(box_size.x), float(box_size.y)),
+            (float(margin.x), float(margin.y)),
+            alignment,
+        )
+        return self.layout_cache.get(key, lambda: self.make_layout(text, scale, box_size, margin, alignment))
+
+    def make_layout(self, text, scale, box_size, margin, alignment):
+        glyph_scale = scale * global_scale
+        sizes = numpy.array([self.glyph_sizes[char] for char in text], numpy.float32).reshape(-1, 2)
+        sizes *= glyph_scale
+        return TextLayout(
+            text,
+            sizes[:, 0],
+            sizes[:, 1],
+            self.font_height * glyph_scale,
+            box_size,
+            margin,
+            alignment,
+        )
 
     def draw(self):
         glLoadIdentity()
         opengl.draw_all(self.quads, self.atlas.texture)
-
-    def purge(self):
-        self.quads.truncate(0)
+        opengl.draw_glyph_runs(self.runs, self.atlas.texture)
+        for buffer in self.panel_runs:
+            if not buffer.hidden:
+                opengl.draw_glyph_runs(buffer, self.atlas.texture)
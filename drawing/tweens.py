@@ -0,0 +1,178 @@
+import numpy
+
+import globals
+from globals.types import Point
+
+
+def linear(p):
+    return p
+
+
+def smoothstep(p):
+    return p * p * (3 - 2 * p)
+
+
+def ease_in(p):
+    return p * p
+
+
+def ease_out(p):
+    return p * (2 - p)
+
+
+def delayed(easing, delay):
+    """An easing that does nothing until the eased progress passes delay, then goes linearly to the end"""
+    return lambda p: numpy.clip((easing(p) - delay) / (1 - delay), 0, 1)
+
+
+class Tween(object):
+    """
+    Something changing a contiguous range of rows in one of the arrays of a ShapeBuffer from one value to
+    another over time. Get them from a TweenEngine
+    """
+
+    def __init__(self, engine, array, rows, start, end, start_time, duration, easing, callback):
+        self.engine = engine
+        self.array = array
+        self.rows = rows
+        self.start = start
+        self.delta = end - start
+        self.start_time = start_time
+        self.duration = duration
+        self.easing = easing
+        self.callback = callback
+        self.active = True
+
+    def cancel(self):
+        if self.active:
+            self.engine.remove(self)
+
+
+class TweenEngine(object):
+    """
+    Runs all the tweens at once. Every tween is a lerp between two sets of rows in a buffer array (colours,
+    vertices, texture coordinates), so each frame we work out the progress of all of them in one go, ease it,
+    and then write all the rows for each array with a single assignment. Tweens that haven't started yet hold
+    their start value.
+
+    If two tweens write the same rows the one added last wins
+    """
+
+    def __init__(self):
+        self.tweens = []
+        self.dirty = False
+
+    def add(self, array, rows, end, start_time, duration, easing=smoothstep, callback=None, start=None):
+        """
+        Tween array[rows] (rows is a slice) to end, starting from start (or its current value) at start_time.
+        The callback is called with no arguments once it's finished
+        """
+        if start is None:
+            start = array[rows]
+        shape = array[rows].shape
+        start = numpy.array(numpy.broadcast_to(start, shape), numpy.float32)
+        end = numpy.array(numpy.broadcast_to(end, shape), numpy.float32)
+        tween = Tween(self, array, rows, start, end, start_time, duration, easing, callback)
+        self.tweens.append(tween)
+        self.dirty = True
+        return tween
+
+    def remove(self, tween):
+        tween.active = False
+        self.tweens.remove(tween)
+        self.dirty = True
+
+    def shape_rows(self, shape):
+        return slice(shape.index, shape.index + shape.num_points)
+
+    def colour(self, shape, colour, start_time, duration, **kwargs):
+        rows = self.shape_rows(shape)
+        return self.add(shape.source.colour_data, rows, colour, start_time, duration, **kwargs)
+
+    def vertices(self, shape, vertices, start_time, duration, **kwargs):
+        rows = self.shape_rows(shape)
+        return self.add(shape.source.vertex_data, rows, vertices, start_time, duration, **kwargs)
+
+    def rect(self, shape, bl, tr, z, start_time, duration, **kwargs):
+        """Move a quad to cover bl to tr, in the same vertex order as set_vertices"""
+        vertices = ((bl.x, bl.y, z), (bl.x, tr.y, z), (tr.x, tr.y, z), (tr.x, bl.y, z))
+        return self.vertices(shape, vertices, start_time, duration, **kwargs)
+
+    def translate(self, shape, offset, start_time, duration, **kwargs):
+        vertices = shape.vertex[0 : shape.num_points] + (offset.x, offset.y, 0)
+        return self.vertices(shape, vertices, start_time, duration, **kwargs)
+
+    def scale(self, shape, scale, start_time, duration, centre=None, **kwargs):
+        """Grow or shrink a shape by scale about centre, which defaults to the middle of the shape"""
+        vertices = shape.vertex[0 : shape.num_points]
+        if centre is None:
+            centre = Point(*vertices[:, :2].mean(axis=0))
+        centre = numpy.array((centre.x, centre.y, 0), numpy.float32)
+        vertices = centre + (vertices - centre) * (scale, scale, 1)
+        return self.vertices(shape, vertices, start_time, duration, **kwargs)
+
+    def zoom(self, shape, scale, start_time, duration, centre=None, **kwargs):
+        """
+        Like scale, but using the shape's transform so that the vertices are never touched. The shape's buffer
+        needs transforms. It starts from its normal size
+        """
+        if centre is None:
+            centre = shape.get_centre()
+        rows = self.shape_rows(shape)
+        start = numpy.array(shape.source.transform_data[rows])
+        start[:, 1:] = (centre.x, centre.y, 1)
+        end = numpy.array(start)
+        end[:, 3] = scale
+        return self.add(shape.source.transform_data, rows, end, start_time, duration, start=start, **kwargs)
+
+    def tc_offset(self, shape, offset, start_time, duration, **kwargs):
+        tc = shape.tc[0 : shape.num_points] + (offset.x, offset.y)
+        return self.add(shape.source.tc_data, self.shape_rows(shape), tc, start_time, duration, **kwargs)
+
+    def rebuild(self):
+        """Gather up all the tweens into arrays we can work on all at once"""
+        tweens = self.tweens
+        self.start_times = numpy.array([tween.start_time for tween in tweens], numpy.float64)
+        self.durations = numpy.array([tween.duration for tween in tweens], numpy.float64)
+
+        easings = {}
+        arrays = {}
+        for i, tween in enumerate(tweens):
+            easings.setdefault(tween.easing, []).append(i)
+            arrays.setdefault(id(tween.array), (tween.array, []))[1].append(i)
+        self.easings = [(easing, numpy.array(indices)) for easing, indices in easings.items()]
+
+        self.groups = []
+        for array, indices in arrays.values():
+            rows = numpy.concatenate([numpy.arange(*tweens[i].rows.indices(len(array))[:2]) for i in indices])
+            owner = numpy.concatenate([numpy.full(tweens[i].start.shape[0], i) for i in indices])
+            start = numpy.concatenate([tweens[i].start for i in indices])
+            delta = numpy.concatenate([tweens[i].delta for i in indices])
+            self.groups.append((array, rows, owner, start, delta))
+        self.dirty = False
+
+    def update(self, t):
+        if not self.tweens:
+            return
+        if self.dirty:
+            self.rebuild()
+        globals.damaged = True
+
+        # A duration of zero just jumps to the end
+        progress = numpy.clip((t - self.start_times) / numpy.maximum(self.durations, 1e-6), 0, 1)
+        eased = numpy.empty_like(progress)
+        for easing, indices in self.easings:
+            eased[indices] = easing(progress[indices])
+
+        for array, rows, owner, start, delta in self.groups:
+            array[rows] = start + delta * eased[owner][:, None]
+
+        finished = numpy.flatnonzero(progress >= 1)
+        if len(finished):
+            done = [self.tweens[i] for i in finished]
+            for tween in done:
+                self.remove(tween)
+            for tween in done:
+                if tween.callback:
+                    tween.callback()
+
@@ -0,0 +1,128 @@
+import heapq
+
+import numpy
+
+import drawing
+import globals
+
+
+class EntityStore(object):
+    """
+    Everything that slides across the screen at a steady speed: blocks, monsters and walls. Rather than each of
+    those being an object with its own Points that moves itself, where they started, when, how fast they're
+    going and how big they are all live in columns here, one row per quad. Each step works out who's gone off the
+    left of the screen with a handful of array operations.
+
+    The quads live in a MotionQuadBuffer. With globals.gpu_motion each one gets written once, where it starts and
+    how fast it's going, and the motion shader does the moving; nothing gets sent to the card again until
+    something comes or goes. Without it we write every position into the buffer ourselves each frame and the
+    shader just draws them where they are.
+
+    The objects are still around to hang the game state off, they just keep the slot add gave them
+    """
+
+    # Bits in state
+    ACTIVE = 1
+    DONE = 2
+
+    def __init__(self, buffer, size=256):
+        self.buffer = buffer
+        self.gpu = globals.gpu_motion
+        self.music_pos = 0
+        self.start_time = numpy.zeros(size, numpy.float64)
+        self.start_pos = numpy.zeros((size, 2), numpy.float64)
+        self.speed = numpy.zeros(size, numpy.float64)
+        self.size = numpy.zeros((size, 2), numpy.float64)
+        self.z = numpy.zeros(size, numpy.float32)
+        self.state = numpy.zeros(size, numpy.uint8)
+        self.quad = numpy.zeros(size, numpy.int64)
+        self.owners = [None] * size
+        # We always give out the lowest free slot so the ones in use stay packed at the start, and we only ever
+        # need to look at the ones before end
+        self.free = list(range(size))
+        self.end = 0
+
+    def grow(self):
+        size = len(self.state)
+        for name in ("start_time", "start_pos", "speed", "size", "z", "state", "quad"):
+            column = getattr(self, name)
+            setattr(self, name, numpy.concatenate((column, numpy.zeros_like(column))))
+        self.owners.extend([None] * size)
+        self.free.extend(range(size, size * 2))
+        heapq.heapify(self.free)
+
+    def add(self, owner, quad, start_time, start_pos, speed, size, z):
+        """
+        Move quad left at speed pixels per ms, starting from start_pos at start_time. Once it's gone off the
+        left of the screen update hands back owner, unless that's None
+        """
+        if not self.free:
+            self.grow()
+        slot = heapq.heappop(self.free)
+        self.end = max(self.end, slot + 1)
+        self.start_time[slot] = start_time
+        self.start_pos[slot] = (start_pos.x, start_pos.y)
+        self.speed[slot] = speed
+        self.size[slot] = (size.x, size.y)
+        self.z[slot] = z
+        self.quad[slot] = quad.index
+        self.state[slot] = self.ACTIVE
+        self.owners[slot] = owner
+
+        rows = slice(quad.index, quad.index + 4)
+        if self.gpu:
+            bl = self.start_pos[slot : slot + 1]
+            self.buffer.vertex_data[rows] = drawing.quad_rects(bl, bl + self.size[slot], z)[0]
+            self.buffer.motion_data[rows] = (start_time, -speed, 0, 0)
+        self.buffer.mark_dirty(rows.start, rows.stop)
+        return slot
+
+    def remove(self, slot):
+        index = self.quad[slot]
+        self.buffer.motion_data[index : index + 4] = 0
+        self.buffer.mark_dirty(index, index + 4)
+        self.state[slot] = 0
+        self.owners[slot] = None
+        heapq.heappush(self.free, slot)
+        while self.end and not self.state[self.end - 1]:
+            self.end -= 1
+
+    def positions(self, music_pos):
+        """The slots that are still moving and where their bottom left corners are at music_pos"""
+        live = numpy.flatnonzero(self.state[: self.end] == self.ACTIVE)
+        bl = self.start_pos[live]
+        bl[:, 0] -= (music_pos - self.start_time[live]) * self.speed[live]
+        return live, bl
+
+    def write(self, live, bl):
+        quads = self.quad[live]
+        rects = drawing.quad_rects(bl, bl + self.size[live], self.z[live])
+        self.buffer.vertex_data[quads[:, None] + numpy.arange(4)] = rects
+        self.buffer.mark_dirty(int(quads.min()), int(quads.max()) + 4)
+
+    def pose(self, music_pos):
+        """Get ready to draw everything as it is at music_pos"""
+        self.music_pos = music_pos
+        if self.gpu:
+            return
+        live, bl = self.positions(music_pos)
+        if len(live):
+            self.write(live, bl)
+
+    def update(self, music_pos):
+        """Move everything on to music_pos, and return the owners of whatever's gone off the left this time"""
+        live, bl = self.positions(music_pos)
+        if not len(live):
+            return []
+        if not self.gpu:
+            self.write(live, bl)
+
+        gone = live[bl[:, 0] + self.size[live, 0] <= 0]
+        if not len(gone):
+            return []
+        self.state[gone] |= self.DONE
+        owners = self.owners
+        return [owners[slot] for slot in gone.tolist() if owners[slot] is not None]
+
+    def draw(self, texture):
+        drawing.draw_moving(self.buffer, texture, self.music_pos)
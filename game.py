@@ -2,14 +2,17 @@ import ui
 import globals
 from globals.types import Point
 import drawing
-import cmath
 import math
 import pygame
 import traceback
 import random
 import os
-
-music_start = 0 * 1000
+import numpy
+import calibration
+import chart
+import entities
+import judgement
+import timers
 
 
 class DifficultyChooser(ui.UIElement):
@@ -68,13 +71,6 @@ class Bolt:
         self.block = None
         self.done = False
         self.bolt = None
-        self.coords = (
-            (-self.size[0] / 2, -self.size[1] / 2),
-            (-self.size[0] / 2, self.size[1] / 2),
-            (self.size[0] / 2, self.size[1] / 2),
-            (self.size[0] / 2, -self.size[1] / 2),
-        )
-        self.radius = 0.5 * math.sqrt(2) * self.size[0]
         self.angle = 0
 
     def disable(self):
@@ -90,13 +86,19 @@ class Bolt:
         self.source = source
         self.pos = source.get_centre()
         self.target = target
-        pos = self.pos + (self.size / 2)
-        self.quad.set_vertices(self.pos, self.pos + self.size, 10)
+        self.set_vertices(self.pos, self.angle)
         self.last = globals.music_pos
+        self.previous = (self.last, self.pos, self.angle)
 
     def get_centre(self):
         return self.pos + (self.size / 2)
 
+    def skip(self, fraction):
+        """Start fraction of the way along, as though we'd been thrown a while ago"""
+        self.pos += (self.target.get_centre() - self.get_centre()) * fraction
+        self.set_vertices(self.pos, self.angle)
+        self.previous = (self.last, self.pos, self.angle)
+
     def finish(self):
         self.done = False
         if self.block:
@@ -108,6 +110,7 @@ class Bolt:
         if self.done:
             return self.finish()
 
+        self.previous = (self.last, self.pos, self.angle)
         elapsed = music_pos - self.last
         self.last = music_pos
         distance = elapsed * self.speed
@@ -122,18 +125,25 @@ class Bolt:
         vector = diff / length
         move = vector * speed * elapsed
         self.pos += move
+        self.set_vertices(self.pos, self.angle)
+
+    def pose(self, music_pos):
+        """We don't move in a straight line, so draw ourselves between where the last two updates put us"""
+        last, pos, angle = self.previous
+        if self.last <= last:
+            return
+        partial = min(max((music_pos - last) / (self.last - last), 0), 1)
+        self.set_vertices(pos + (self.pos - pos) * partial, angle + (self.angle - angle) * partial)
 
-        vertices = [0, 0, 0, 0]
-        for i, coord in enumerate(self.coords):
-            p = coord[0] + coord[1] * 1j
-            distance, old_angle = cmath.polar(p)
-            c = cmath.rect(self.radius, old_angle + self.angle)
-            vertices[i] = self.pos + Point(c.real, c.imag) + self.size / 2
-        self.quad.set_all_vertices(vertices, 10)
+    def set_vertices(self, pos, angle):
+        # The shader does the spinning, so all we need to say is where we are and which way we're pointing
+        self.quad.set_vertices(pos, pos + self.size, 10)
+        self.quad.set_transform(angle, pivot=pos + self.size / 2)
 
     def set_type(self, num, time, block):
         self.block = block
-        block.bolt = self
+        if block:
+            block.bolt = self
         self.quad.set_texture_coordinates(
             self.atlas.texture_coords(f"resource/sprites/magic_bolt_{num%8+1}.png")
         )
@@ -180,25 +190,52 @@ class Sprite:
         self.active_bolts = []
 
     def delete(self):
+        for timer in self.shield, self.ducking, self.smashing:
+            if timer:
+                timer.cancel()
         self.quad.delete()
         self.shield_quad.delete()
 
-        for bolt in self.bolts:
+        for bolt in self.bolts + self.active_bolts:
             bolt.delete()
+        self.bolts = []
+        self.active_bolts = []
+
+    def reset(self):
+        """Go back to standing still with nothing going on, keeping all our quads"""
+        for timer in self.shield, self.ducking, self.smashing:
+            if timer:
+                timer.cancel()
+        self.shield = self.ducking = self.smashing = False
+        self.shield_quad.disable()
 
         for bolt in self.active_bolts:
-            bolt.delete()
+            bolt.finish()
+            bolt.disable()
+        self.bolts.extend(self.active_bolts)
+        self.active_bolts = []
+
+        self.jumping = False
+        self.pos = Point(0, 0)
+        self.quad.set_vertices(self.start_pos, self.start_pos + self.size, 50)
+        self.quad.set_texture_coordinates(self.tc_coords[0])
 
     def get_centre(self):
         return self.bl + self.pos + (self.size / 2)
 
     def enable_shield(self, num):
         self.shield_quad.set_texture_coordinates(self.shield_tc[num % len(self.shield_tc)])
-        self.shield = globals.music_pos + self.shield_duration
+        if self.shield:
+            self.shield.cancel()
+        self.shield = globals.music_timers.call_at(globals.music_pos + self.shield_duration, self.end_shield)
         pos = self.start_pos + self.pos - self.shield_offset
         self.shield_quad.set_vertices(pos, pos + self.shield_size, 51)
         self.shield_quad.enable()
 
+    def end_shield(self):
+        self.shield = False
+        self.shield_quad.disable()
+
     def update(self, music_pos):
         new_bolts = []
         for bolt in self.active_bolts:
@@ -209,44 +246,41 @@ class Sprite:
                 new_bolts.append(bolt)
         self.active_bolts = new_bolts
 
-        if self.shield and music_pos > self.shield:
-            self.shield = False
-            self.shield_quad.disable()
+        # The shield, ducking and smashing all get ended by their timers, so the only thing that can finish here
+        # is a jump
+        if self.jumping and not self.ducking and self.jump_height(music_pos) < 0:
+            self.pos = Point(0, 0)
+            self.jumping = False
+            pos = self.start_pos
+            self.quad.set_vertices(pos, pos + self.size, 50)
+            if self.shield:
+                pos -= self.shield_offset
+                self.shield_quad.set_vertices(pos, pos + self.shield_size, 51)
+
+        self.pose(music_pos)
+
+    def jump_height(self, music_pos):
+        t = music_pos - self.jumping
+        return (self.jump_velocity * t) + (self.gravity * t * t)
 
-        animated = False
+    def pose(self, music_pos):
+        """Put everything where it should be drawn at music_pos. This doesn't change what we're doing"""
+        for bolt in self.active_bolts:
+            bolt.pose(music_pos)
 
         if self.ducking:
-            if music_pos < self.ducking:
-                return
-            else:
-                self.ducking = False
-                self.quad.translate(Point(0, -32))
-            animated = True
+            return
 
         if self.jumping:
-            t = music_pos - self.jumping
-            self.pos = Point(0, (self.jump_velocity * t) + (self.gravity * t * t))
-            if self.pos.y < 0:
-                self.pos = Point(0, 0)
-                self.jumping = False
+            self.pos = Point(0, max(self.jump_height(music_pos), 0))
             pos = self.start_pos + self.pos
             self.quad.set_vertices(pos, pos + self.size, 50)
             if self.shield:
                 pos -= self.shield_offset
                 self.shield_quad.set_vertices(pos, pos + self.shield_size, 51)
-
-            animated = True
+            return
 
         if self.smashing:
-            t = music_pos - self.smashing
-            pos = int(t // self.per_frame)
-            if pos < len(self.smashing_tc_coords):
-                self.quad.set_texture_coordinates(self.smashing_tc_coords[pos])
-                animated = True
-            else:
-                self.smashing = False
-
-        if animated:
             return
 
         pos = int(music_pos // self.per_frame) % len(self.tc_coords)
@@ -260,33 +294,58 @@ class Sprite:
         self.last_pos = 0
 
     def duck(self):
-        self.ducking = globals.music_pos + self.duck_duration
+        if self.ducking:
+            # Already down there, we just stay down for longer
+            self.ducking.cancel()
+        else:
+            self.quad.translate(Point(0, 32))
+        self.ducking = globals.music_timers.call_at(globals.music_pos + self.duck_duration, self.end_duck)
         self.quad.set_texture_coordinates(self.tc_coords[2])
-        self.quad.translate(Point(0, 32))
 
-    def shoot(self, num, time, block):
+    def end_duck(self):
+        self.ducking = False
+        self.quad.translate(Point(0, -32))
+
+    def shoot(self, num, time, block, elapsed=0):
+        """Throw a bolt that lands in time ms, or one that was thrown elapsed ms ago if we're catching up"""
         # We create a new active bolt
         if len(self.bolts) == 0:
             return
         bolt = self.bolts.pop(0)
         bolt.set_pos(self.parent.right_track, self)
         # bolt.target = self.parent.right_track
-        bolt.set_type(num, time, block)
+        bolt.set_type(num, time - elapsed, block)
+        if elapsed:
+            bolt.skip(elapsed / time)
         bolt.enable()
         self.active_bolts.append(bolt)
 
     def smash(self, wall):
         print("smash!", wall)
-        wall.smash()
-        self.smashing = globals.music_pos
+        if wall:
+            wall.smash()
+        if self.smashing:
+            self.smashing.cancel()
         # Start a short animation
+        self.smash_frame(globals.music_pos, 0)
+
+    def smash_frame(self, start, frame):
+        if frame >= len(self.smashing_tc_coords):
+            self.smashing = False
+            return
+        self.quad.set_texture_coordinates(self.smashing_tc_coords[frame])
+        self.smashing = globals.music_timers.call_at(
+            start + (frame + 1) * self.per_frame, self.smash_frame, start, frame + 1
+        )
 
 
 class MainMenu(ui.HoverableBox):
     line_width = 1
 
     def __init__(self, parent, bl, tr):
-        self.border = drawing.QuadBorder(globals.ui_buffer, line_width=self.line_width)
+        # Everything in the menu goes in its own part of the buffers, so that it can be hidden in one go
+        self.reserve_panel(quads=192, runs=40)
+        self.border = drawing.QuadBorder(self.arena, line_width=self.line_width)
         self.level_buttons = []
         self.ticks = []
         super(MainMenu, self).__init__(parent, bl, tr, (0.05, 0.05, 0.05, 1))
@@ -319,7 +378,7 @@ class MainMenu(ui.HoverableBox):
         )
         self.audio_offsets = [(offset, i) for i, offset in enumerate(range(-200, 201))]
         self.slider = ui.Slider(
-            self, Point(0.1, 0.3), Point(0.9, 0.4), self.audio_offsets, self.slider_callback
+            self, Point(0.1, 0.25), Point(0.9, 0.35), self.audio_offsets, self.slider_callback
         )
         self.slider.index = int(len(self.audio_offsets) // 2)
         self.slider.set_pointer()
@@ -327,12 +386,28 @@ class MainMenu(ui.HoverableBox):
         self.audio_offset = 0
         self.slider_text = ui.TextBox(
             self,
-            Point(0.3, 0.25),
-            Point(0.7, 0.3),
+            Point(0.3, 0.2),
+            Point(0.7, 0.25),
             f"Audio delay : {self.audio_offset:2d} ms",
             scale=2,
             alignment=drawing.texture.TextAlignments.CENTRE,
         )
+        # How far ahead we draw things, to make up for however long the screen takes to show them
+        self.visual_slider = ui.Slider(
+            self, Point(0.1, 0.4), Point(0.9, 0.5), self.audio_offsets, self.visual_slider_callback
+        )
+        self.visual_slider.index = int(len(self.audio_offsets) // 2)
+        self.visual_slider.set_pointer()
+        self.visual_slider.enable()
+        self.visual_offset = 0
+        self.visual_slider_text = ui.TextBox(
+            self,
+            Point(0.3, 0.35),
+            Point(0.7, 0.4),
+            f"Visual delay : {self.visual_offset:2d} ms",
+            scale=2,
+            alignment=drawing.texture.TextAlignments.CENTRE,
+        )
 
         self.difficulty = DifficultyChooser(
             self,
@@ -353,6 +428,12 @@ class MainMenu(ui.HoverableBox):
         )
         self.resume_button.disable()
         self.quit_button = ui.TextBoxButton(self, "Quit", Point(0.45, 0.1), size=2, callback=self.parent.quit)
+        self.practice_button = ui.TextBoxButton(
+            self, "Practice", Point(0.1, 0.1), size=2, callback=self.parent.start_practice
+        )
+        self.calibrate_button = ui.TextBoxButton(
+            self, "Calibrate", Point(0.7, 0.1), size=2, callback=self.parent.start_calibration
+        )
 
         pos = Point(0.2, 0.8)
 
@@ -367,26 +448,36 @@ class MainMenu(ui.HoverableBox):
         self.audio_offset = self.audio_offsets[index][0]
         self.slider_text.set_text(f"Audio delay : {self.audio_offset:2d} ms")
 
+    def visual_slider_callback(self, index):
+        self.visual_offset = self.audio_offsets[index][0]
+        self.visual_slider_text.set_text(f"Visual delay : {self.visual_offset:2d} ms")
+
+    def set_slider(self, slider, offset):
+        """Move slider to the nearest it can get to offset, as if someone had dragged it there"""
+        low, high = self.audio_offsets[0][0], self.audio_offsets[-1][0]
+        slider.index = min(max(int(round(offset)), low), high) - low
+        slider.set_pointer()
+        slider.callback(slider.index)
+
+    def set_audio_offset(self, offset):
+        self.set_slider(self.slider, offset)
+
+    def set_visual_offset(self, offset):
+        self.set_slider(self.visual_slider, offset)
+
     def enable(self):
+        # Our children keep their own enabled state while we're hidden, so showing and hiding is just a matter of
+        # the panel and whether we're clickable
         if not self.enabled:
             self.root.register_ui_element(self)
-            self.border.enable()
-        for button in self.level_buttons:
-            button.enable()
-        super(MainMenu, self).enable()
-        for i, tick in enumerate(self.ticks):
-            if self.parent.done[i]:
-                tick.enable()
-            else:
-                tick.disable()
+            self.show_panel()
+        self.enabled = True
 
     def disable(self):
         if self.enabled:
             self.root.remove_ui_element(self)
-            self.border.disable()
-        super(MainMenu, self).disable()
-        for tick in self.ticks:
-            tick.disable()
+            self.hide_panel()
+        self.enabled = False
 
     def get_difficulty(self):
         return self.difficulty.current_text
@@ -421,6 +512,7 @@ class GameOver(ui.HoverableBox):
         self.quit_button = ui.TextBoxButton(self, "Quit", Point(0.7, 0.1), size=2, callback=parent.quit)
 
     def replay(self, pos):
+        self.parent.main_menu.resume_button.enable()
         self.parent.main_menu.enable()
         self.parent.previous_runs = 0
         self.parent.gaps = 0
@@ -446,70 +538,41 @@ class Note:
         self.duration = duration
         self.note = note
         self.difficulty = difficulty
-        self.block = None
 
 
 class NoteTiming:
-    def __init__(self, filename):
-        self.notes = []
-
-        interval = None
-        with open(filename, "r") as file:
-            for line in file:
-                line = line.strip()
-                if "#" in line:
-                    line = line[: line.index("#")].strip()
-
-                if not line:
-                    continue
-
-                if interval is None and line.startswith("+"):
-                    # Line of the form +n/m means the previous entry was the start, the next was the end, and they're m beats apart, with the first n set
-                    n, m = (int(v) for v in line[1:].split("/"))
-                    interval = [note, n, m]
-                    continue
-                ms, duration, instrument, note, difficulty = line.split(",")
-                ms, duration, difficulty = (float(v) for v in (ms, duration, difficulty))
-                instrument, note = (v.strip() for v in (instrument, note))
-                note = Note(ms, duration, instrument, note, difficulty)
-                if interval:
-                    diff = (note.time - interval[0].time) / interval[2]
-                    for i in range(1, interval[1]):
-                        new_note = Note(
-                            ms=interval[0].time + diff * i,
-                            duration=interval[0].duration,
-                            instrument=interval[0].instrument,
-                        )
-                        self.notes.append(new_note)
-                    interval = None
-
-                self.notes.append(note)
-
-        self.current_note = 0
-        self.notes.sort(key=lambda note: note.time)
-        self.current_play = self.notes[::]
+    """
+    The notes in the chart. They live in a compiled array (see chart.py), and we only make Note objects for
+    the ones somebody actually asks for
+    """
 
-    def get_notes(self, pos):
-        for i, note in enumerate(self.current_play):
-            if note.time <= pos:
-                yield note
-            else:
-                self.current_play = self.current_play[i:]
-                return
+    # A gap this long (in ms) with no notes means a new section is starting
+    section_gap = 600
 
-        self.current_play = []
+    def __init__(self, filename):
+        self.chart = chart.load(filename)
+        self.times = self.chart.notes["time"]
+        self.keys = self.chart.keys
+        self.sections = self.chart.sections(self.section_gap)
+        self.current_note = 0
+        self.current_play = 0
 
-    def get_all_notes(self, instruments, difficulty):
-        for note in self.notes:
+    def make_notes(self, rows):
+        instruments = self.chart.instruments
+        keys = self.chart.keys
+        for ms, duration, instrument, key, difficulty in rows.tolist():
+            yield Note(ms, duration, instruments[instrument], keys[key], difficulty)
 
-            if note.instrument in instruments and note.difficulty <= difficulty:
-                yield note
+    def get_notes(self, pos):
+        end = int(numpy.searchsorted(self.times, pos, side="right"))
+        start, self.current_play = self.current_play, max(self.current_play, end)
+        return self.make_notes(self.chart.notes[start:end])
 
     @property
     def current(self):
         try:
-            return self.notes[self.current_note]
-        except IndexError:
+            return next(self.make_notes(self.chart.notes[self.current_note : self.current_note + 1]))
+        except StopIteration:
             return 9999999999
 
     def next(self):
@@ -561,117 +624,148 @@ print_trans = {
 
 
 def letter_from_note(note, difficulty):
+    return letter_from_key(note.note, difficulty)
+
+
+def letter_from_key(key, difficulty):
     try:
-        return note_subs[difficulty][note.note]
+        return note_subs[difficulty][key]
     except KeyError:
-        return note.note
+        return key
+
+
+def crate_image(letter):
+    """The name of the baked crate with the given letter on it"""
+    return f"crate_{ord(letter)}"
+
+
+def bake_crates(atlas, letters, scale=2):
+    """
+    Draw each letter onto its own copy of the crate and put them all in the atlas, so that a Block only needs
+    one quad instead of a crate and a letter from the font. They're drawn at scale times the size of the crate
+    so the letters can be an exact multiple of the font size
+    """
+    font = globals.text_manager.atlas
+    with open(os.path.join(globals.dirs.resource, font.texture.filenames[0]), "rb") as f:
+        font_image = pygame.image.load(f)
+    with open(Block.image, "rb") as f:
+        crate = pygame.image.load(f)
+    crate = pygame.transform.scale(crate, (crate.get_width() * scale, crate.get_height() * scale))
+    size = Point(*crate.get_size())
+
+    images = {}
+    for letter in letters:
+        rect = font.surface_rect(print_trans.get(letter, letter))
+        # The letter used to cover the middle 60% of the crate, get as close to that as we can with whole pixels
+        glyph_scale = max(int(round(size.y * 0.6 / rect.height)), 1)
+        glyph = pygame.transform.scale(
+            font_image.subsurface(rect), (rect.width * glyph_scale, rect.height * glyph_scale)
+        )
+        image = crate.copy()
+        image.blit(glyph, ((size.x - glyph.get_width()) // 2, (size.y - glyph.get_height()) // 2))
+        images[crate_image(letter)] = image
+    atlas.add_images(images)
+
+
+class Pool:
+    """
+    A fixed number of entities made up front and handed out as their notes come on screen. They come back
+    when they're deleted, so how many we make depends on how busy the screen gets rather than how long the song
+    is. If it does run dry we make another rather than drop a note; it just means the size wants bumping
+    """
+
+    def __init__(self, factory, size, *args):
+        self.factory = factory
+        self.args = args
+        self.free = [self.make() for i in range(size)]
+
+    def make(self):
+        item = self.factory(*self.args)
+        item.pool = self
+        return item
+
+    def acquire(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            return self.make()
+
+    def release(self, item):
+        self.free.append(item)
 
 
 class Block:
     image = "resource/sprites/crate.png"
 
-    def __init__(self, time, note, size, pos, speed):
-        self.time = time
-        self.note = note
-        note.block = self
-        self.quad = None
-        self.letter = None
-        self.start_pos = pos
-        self.speed = speed
-        self.size = size
-        self.pos = self.start_pos
-        self.open = False
-        self.closed = False
-        self.done = False
-        self.hit = False
+    def __init__(self, atlas, store):
+        self.atlas = atlas
+        self.store = store
+        self.pool = None
+        # The quad lives as long as we do, it's just hidden while we're sat in the pool. Where it goes is up to
+        # the store while we've got a slot in it
+        self.quad = drawing.Quad(store.buffer)
+        self.quad.disable()
+        self.slot = None
         self.wall = None
         self.bolt = None
 
-    def update(self, music_pos):
-        if self.done:
-            return self.done
-
-        if self.quad is None:
-            # The first time we're called we can grab a qua
-            self.quad = drawing.Quad(
-                globals.quad_buffer,
-                tc=globals.current_view.atlas.texture_coords(self.image),
-            )
-            letter = letter_from_note(self.note, globals.current_view.difficulty)
-            self.key = ord(letter)
-            try:
-                letter = print_trans[letter]
-            except KeyError:
-                pass
-            self.letter = globals.text_manager.letter(letter, drawing.texture.TextTypes.SCREEN_RELATIVE)
-
-        elapsed = music_pos - self.time
-        moved = elapsed * self.speed
-        self.pos = self.start_pos - Point(moved, 0)
-        tr = self.pos + self.size
-
-        self.quad.set_vertices(self.pos, tr, 10)
-        margin = self.size * 0.2
-        self.letter.set_vertices(self.pos + margin, tr - margin, 11)
-
-        self.done = tr.x <= 0
-        return self.done
+    def setup(self, track, row, time, note, size, pos, speed):
+        """Get ready to come on screen at time for the given row of a track's notes. note is the key's name"""
+        self.track = track
+        self.row = row
+        # The letter is already baked onto the crate
+        letter = letter_from_key(note, globals.current_view.difficulty)
+        self.key = ord(letter)
+        self.quad.set_texture_coordinates(self.atlas.texture_coords(crate_image(letter)))
+        self.open = False
+        self.closed = False
+        self.hit = False
+        self.quad.enable()
+        self.slot = self.store.add(self, self.quad, time, pos, speed, size, 10)
 
     def mark_hit(self):
         self.hit = True
 
     def delete(self):
-        self.done = True
-        if self.quad:
-            self.quad.delete()
-            self.quad = None
-        if self.letter:
-            self.letter.delete()
-            self.letter = None
+        """Hide ourselves and go back in the pool. It doesn't matter if this gets called more than once"""
+        if self.slot is None:
+            return
+        self.store.remove(self.slot)
+        self.slot = None
+        self.quad.disable()
+        if self.wall:
+            self.wall.block = None
+            self.wall = None
+        if self.bolt:
+            self.bolt.block = None
+            self.bolt = None
+        if self.pool:
+            self.pool.release(self)
 
 
-class Monster(Block):
+class Monster:
     image = "resource/sprites/iron_devil.png"
 
-    def __init__(self, time, note, size, pos, speed):
-        self.time = time
-        self.note = note
-        self.quad = None
-        self.letter = None
-        self.start_pos = pos
-        self.speed = speed
-        self.size = size
-        self.pos = self.start_pos
-        self.open = False
-        self.done = False
-        self.hit = False
-
-    def update(self, music_pos):
-        if self.done:
-            return self.done
-
-        if self.quad is None:
-            # The first time we're called we can grab a qua
-            self.quad = drawing.Quad(
-                globals.quad_buffer,
-                tc=globals.current_view.atlas.texture_coords(self.image),
-            )
-
-        elapsed = music_pos - self.time
-        moved = elapsed * self.speed
-        self.pos = self.start_pos - Point(moved, 0)
-        tr = self.pos + self.size
-
-        self.quad.set_vertices(self.pos, tr, 10)
+    def __init__(self, atlas, store):
+        self.store = store
+        self.pool = None
+        self.quad = drawing.Quad(store.buffer, tc=atlas.texture_coords(self.image))
+        self.quad.disable()
+        self.slot = None
 
-        self.done = tr.x <= 0
-        return self.done
+    def setup(self, track, time, size, pos, speed):
+        self.track = track
+        self.quad.enable()
+        self.slot = self.store.add(self, self.quad, time, pos, speed, size, 10)
 
     def delete(self):
-        self.done = True
-        if self.quad:
-            self.quad.delete()
-            self.quad = None
+        if self.slot is None:
+            return
+        self.store.remove(self.slot)
+        self.slot = None
+        self.quad.disable()
+        if self.pool:
+            self.pool.release(self)
 
 
 class Wall(Monster):
@@ -685,66 +779,53 @@ class BigMonster(Monster):
 class DestructableWall:
     image = "resource/sprites/low_wall.png"
 
-    def __init__(self, time, note, size, pos, speed, block):
-        self.top_size = Point(size.x, size.y * 5 / 6)
-        self.bottom_size = Point(size.x, size.y / 6)
-        self.time = time
-        self.note = note
-        self.bottom_quad = None
-        self.top_quad = None
-        self.letter = None
-        self.start_pos = pos
-        self.speed = speed
-        self.size = size
-        self.pos = self.start_pos
-        self.open = False
-        self.done = False
-        self.hit = False
-        self.block = block
-        block.wall = self
+    def __init__(self, atlas, store):
+        self.store = store
+        self.pool = None
+        tc = [[0, 0], [0, 5 / 6], [1, 5 / 6], [1, 0]]
+        atlas.transform_coords(self.image, tc)
+        self.top_quad = drawing.Quad(store.buffer, tc=tc)
+        tc = [[0, 0], [0, 1 / 6], [1, 1 / 6], [1, 0]]
+        atlas.transform_coords(self.image, tc)
+        self.bottom_quad = drawing.Quad(store.buffer, tc=tc)
+        self.top_quad.disable()
+        self.bottom_quad.disable()
+        self.slot = None
+        self.bottom_slot = None
+        self.block = None
 
-    def update(self, music_pos):
-        if self.done:
-            return self.done
-
-        if self.top_quad is None:
-            # The first time we're called we can grab a qua
-            tc = [[0, 0], [0, 5 / 6], [1, 5 / 6], [1, 0]]
-            globals.current_view.atlas.transform_coords(self.image, tc)
-            self.top_quad = drawing.Quad(globals.quad_buffer, tc=tc)
-            tc = [[0, 0], [0, 1 / 6], [1, 1 / 6], [1, 0]]
-            globals.current_view.atlas.transform_coords(self.image, tc)
-            self.bottom_quad = drawing.Quad(globals.quad_buffer, tc=tc)
-
-        elapsed = music_pos - self.time
-        moved = elapsed * self.speed
-        self.pos = self.start_pos - Point(moved, 0)
-        tr = self.pos + self.size
-
-        z = 10
-        for quad, size, offset in (
-            (self.bottom_quad, self.bottom_size, Point(0, 0)),
-            (self.top_quad, self.top_size, Point(0, 64)),
-        ):
-            if quad:
-                quad.set_vertices(self.pos + offset, self.pos + size + offset, z)
-            z -= 1
-
-        self.done = tr.x <= 0
-        return self.done
+    def setup(self, track, time, size, pos, speed, block):
+        self.track = track
+        self.block = block
+        if block:
+            block.wall = self
+        # We might have been smashed the last time round
+        self.top_quad.enable()
+        self.bottom_quad.enable()
+        # The two halves go off the screen together, so only the top one needs to tell anyone about it
+        self.slot = self.store.add(
+            self, self.top_quad, time, pos + Point(0, 64), speed, Point(size.x, size.y * 5 / 6), 9
+        )
+        self.bottom_slot = self.store.add(None, self.bottom_quad, time, pos, speed, Point(size.x, size.y / 6), 10)
 
     def delete(self):
-        self.done = True
-        if self.top_quad:
-            self.top_quad.delete()
-            self.top_quad = None
-        if self.bottom_quad:
-            self.bottom_quad.delete()
-            self.bottom_quad = None
+        if self.slot is None:
+            return
+        self.store.remove(self.slot)
+        self.slot = None
+        self.top_quad.disable()
+        self.smash()
+        if self.block:
+            self.block.wall = None
+            self.block = None
+        if self.pool:
+            self.pool.release(self)
 
     def smash(self):
-        self.bottom_quad.delete()
-        self.bottom_quad = None
+        if self.bottom_slot is not None:
+            self.store.remove(self.bottom_slot)
+            self.bottom_slot = None
+            self.bottom_quad.disable()
 
 
 class Track:
@@ -761,218 +842,175 @@ class Track:
         self.absolute_speed = (self.speed * self.region.absolute.size[0]) / 1000
         self.absolute_line_pos = parent.get_absolute(Point(parent.line_pos, 0)).x
 
-        self.notes = list(notes)
-
-        self.starts = []
+        # The notes are rows of the compiled chart and they stay that way. A block only gets taken out of the
+        # pool when its note is about to come on screen, and it's keyed by its row while it's out
+        self.notes = notes
+        self.keys = parent.notes.keys
+        self.pools = parent.pools
 
         block_size = self.region.absolute.size[1] * 0.6
+        self.block_size = Point(block_size, block_size)
+        self.block_pos = self.region.absolute.top_right - Point(
+            0, block_size + (self.region.absolute.size[1] - block_size) / 2
+        )
         transit_pixels = self.region.absolute.size[0] - self.absolute_line_pos + (block_size / 2)
         self.transit_ms = transit_pixels / self.absolute_speed
 
-        for note in self.notes:
-            # The time this wants introducing is the time that it should cross the line minus the amount of
-            # time that it will take to go from the top to the line pos
-            time = note.time - self.transit_ms + parent.previous_runs + parent.gaps
-            self.starts.append(
-                Block(
-                    time,
-                    note,
-                    size=Point(block_size, block_size),
-                    pos=self.region.absolute.top_right
-                    - Point(0, block_size + (self.region.absolute.size[1] - block_size) / 2),
-                    speed=self.absolute_speed,
-                )
-            )
-
-        self.current_starts = self.starts[::]
-        self.in_flight = []
-
-        self.open_by_key = {}
+        self.spawned = {}
+        self.judge = judgement.Judge(self.window_before, self.window_after)
+
+        # Everything that happens to a block happens at a time we know now, so put it all on the timeline. The
+        # time a block wants introducing is the time that it should cross the line minus the amount of time that
+        # it will take to go from the top to the line pos
+        self.block_times = notes["time"] + parent.previous_runs + parent.gaps
+        self.spawn_times = self.block_times - self.transit_ms
+        # They all start in the same place and move at the same speed, so they're all around for the same time
+        self.block_life = (self.block_pos.x + self.block_size.x) / self.absolute_speed
+        rows = range(len(notes))
+        timeline = parent.timeline
+        timeline.add(self.spawn_times, self.spawn, rows)
+        # They become open window milliseconds before their target time
+        timeline.add(self.block_times - self.window_before, self.open, rows)
+        timeline.add(self.block_times + self.window_after, self.close, rows)
 
     def delete(self):
-        for block in self.starts:
-            block.delete()
-
-    def get_blocks(self, pos):
-        for i, note in enumerate(self.current_starts):
-            if note.time <= pos:
-                yield note
-            else:
-                self.current_starts = self.current_starts[i:]
-                return
-
-        self.current_starts = []
+        self.clear()
 
-    def update(self, t, music_pos):
-        # Do we need to start drawing any new blocks?
-        for new_block in self.get_blocks(music_pos):
-            self.in_flight.append(new_block)
+    def clear(self):
+        """Give back everything we've got out"""
+        for block in self.spawned.values():
+            block.delete()
+        self.spawned = {}
+        self.judge.clear()
 
-        # Update the position of any existing blocks
-        finished_blocks = []
-        new_in_flight = []
+    def spawn(self, row):
+        block = self.pools[Block].acquire()
+        block.setup(
+            self,
+            row,
+            self.spawn_times[row],
+            self.keys[self.notes["key"][row]],
+            self.block_size,
+            self.block_pos,
+            self.absolute_speed,
+        )
+        self.spawned[row] = block
+        return block
+
+    def remove(self, block):
+        """Take a block off the track, either because it's been hit or because it's gone off the end"""
+        del self.spawned[block.row]
+        if block.open:
+            # The block's going back in the pool to be some other note, so the judge mustn't hang on to it
+            self.judge.close(block.key, block)
+            block.open = False
+        block.delete()
+
+    def seek(self, music_pos):
+        """
+        Put the track in the state it would be in if we'd played up to music_pos. The only blocks that can be
+        on the screen are the ones spawned less than a block's lifetime ago, so that's all we look at
+        """
+        self.clear()
+        first = int(numpy.searchsorted(self.spawn_times, music_pos - self.block_life, side="right"))
+        last = int(numpy.searchsorted(self.spawn_times, music_pos, side="right"))
+        for row in range(first, last):
+            block = self.spawn(row)
+            if music_pos >= self.block_times[row] + self.window_after:
+                # Too late to hit this one, but it's not fair to count it as a miss either
+                block.closed = True
+            elif music_pos >= self.block_times[row] - self.window_before:
+                self.open(row)
+
+    def open(self, row):
+        block = self.spawned.get(row)
+        if block is None or block.open or block.closed:
+            return
+        self.judge.open(block.key, self.block_times[row], block)
+        block.open = True
 
-        for block in self.in_flight:
-            done = block.update(music_pos)
-            if done:
-                finished_blocks.append(block)
-                block.delete()
-            else:
-                new_in_flight.append(block)
-                # They become open window milliseconds before their target time
-                block_time = block.note.time + self.parent.previous_runs + self.parent.gaps
-                if (
-                    not block.open
-                    and not block.closed
-                    and globals.music_pos >= block_time - self.window_before
-                ):
-                    try:
-                        self.open_by_key[block.key].append(block)
-                    except KeyError:
-                        self.open_by_key[block.key] = [block]
-                    block.open = True
-
-                elif block.open and globals.music_pos >= block_time + self.window_after:
-                    # You missed your chance to get this one buddy!
-                    if not block.hit:
-                        self.parent.miss(block)
-                    block.open = False
-                    block.closed = True
-                    try:
-                        a = self.open_by_key[block.key]
-                        a = [b for b in a if b is not block]
-                        if not a:
-                            del self.open_by_key[block.key]
-                        else:
-                            self.open_by_key[block.key] = a
-                    except KeyError:
-                        pass
-
-        self.in_flight = new_in_flight
-
-    def key_down(self, key):
-        try:
-            hit_blocks = self.open_by_key[key]
-        except KeyError:
+    def close(self, row):
+        block = self.spawned.get(row)
+        if block is None or not block.open:
+            return
+        # You missed your chance to get this one buddy!
+        if not block.hit:
+            self.parent.miss(block)
+        block.open = False
+        block.closed = True
+        self.judge.close(block.key, block)
+
+    def key_down(self, key, when):
+        # Judge against when the key was actually pressed, not when we got round to handling it
+        hit_block = self.judge.hit(key, self.parent.music_pos_at(when))
+        if hit_block is None:
+            # if we get here it means the key didn't delete any blocks. That's a paddlin'
             return False
 
-        for hit_block in hit_blocks:
-            # Only permit this if it's within the right amount of time
-            hit_time = (globals.music_pos - self.parent.previous_runs) - hit_block.note.time
-            window = self.window_before if hit_time < 0 else self.window_after
-            if abs(hit_time) < window:
-                self.parent.hit(hit_block)
-                hit_block.mark_hit()
-                hit_block.delete()
-                hit_block.closed = True
-                hit_block.open = False
-                a = self.open_by_key[hit_block.key]
-                a.pop(0)
-                if not a:
-                    del self.open_by_key[hit_block.key]
-                else:
-                    self.open_by_key[hit_block.key] = a
-                return True
-                # del self.open_by_key[key]
-
-        # if we get here it means the key didn't delete any blocks. That's a paddlin'
-        return False
+        self.parent.hit(hit_block)
+        hit_block.mark_hit()
+        hit_block.closed = True
+        hit_block.open = False
+        self.remove(hit_block)
+        return True
 
 
 class MonsterTrack(Track):
-    # The monster track puts monsters in the players path that can be jumped with the 'a' key
+    # The monster track puts monsters in the players path that can be jumped with the 'a' key. This is what each
+    # key puts there, how big it is and where it starts relative to the bottom right of the screen
+    monsters = {
+        "a": (Monster, Point(64, 64), Point(300, 214)),
+        "q": (Monster, Point(64, 64), Point(300, 214)),
+        "t": (BigMonster, Point(121, 131), Point(300, 214)),
+        # For these we'll put a wall that needs to be ducked under
+        "d": (Wall, Point(64, 384), Point(300, 214 + 48)),
+        "e": (Wall, Point(64, 384), Point(300, 214 + 48)),
+        "space": (DestructableWall, Point(64, 384) * 1.15, Point(300, 214)),
+    }
+
     def __init__(self, parent, pos, height, notes, atlas):
         super().__init__(parent, pos, height, notes, atlas)
-        self.monster_starts = []
-        monster_size = 64
-        # We also want to manage the devil positions
-        for note in self.notes:
-            # The time this wants introducing is the time that it should cross the line minus the amount of
-            # time that it will take to go from the top to the line pos
-            time = note.time - self.transit_ms + parent.previous_runs + parent.gaps
-            if note.note in ["a", "q"]:
-                self.monster_starts.append(
-                    Monster(
-                        time,
-                        note,
-                        size=Point(monster_size, monster_size),
-                        pos=parent.absolute.bottom_right + Point(300, 214),
-                        speed=self.absolute_speed,
-                    )
-                )
-            elif note.note in ["t"]:
-                self.monster_starts.append(
-                    BigMonster(
-                        time,
-                        note,
-                        size=Point(121, 131),
-                        pos=parent.absolute.bottom_right + Point(300, 214),
-                        speed=self.absolute_speed,
-                    )
-                )
-
-            elif note.note in ["d", "e"]:
-                # For these we'll put a wall that needs to be ducked under
-                self.monster_starts.append(
-                    Wall(
-                        time,
-                        note,
-                        size=Point(64, 384),
-                        pos=parent.absolute.bottom_right + Point(300, 214 + 48),
-                        speed=self.absolute_speed,
-                    )
-                )
-            elif note.note == "space":
-                self.monster_starts.append(
-                    DestructableWall(
-                        time,
-                        note,
-                        size=Point(64, 384) * 1.15,
-                        pos=parent.absolute.bottom_right + Point(300, 214),
-                        speed=self.absolute_speed,
-                        block=note.block,
-                    )
-                )
-
-        self.current_monster_starts = self.monster_starts[::]
-        self.monsters_in_flight = []
-
-    # This code duplication is nasty, but I'm in a rush
-    def get_monsters(self, pos):
-        for i, note in enumerate(self.current_monster_starts):
-            if note.time <= pos:
-                yield note
-            else:
-                self.current_monster_starts = self.current_monster_starts[i:]
-                return
-
-        self.current_monster_starts = []
-
-    def update(self, t, music_pos):
-        super().update(t, music_pos)
-
-        # Do we need to start drawing any new monsters?
-        for new_monster in self.get_monsters(music_pos):
-            self.monsters_in_flight.append(new_monster)
+        self.monsters_in_flight = set()
+        # Monsters come on at the same time as their blocks
+        is_monster = numpy.array([key in self.monsters for key in self.keys], dtype=bool)
+        self.monster_rows = numpy.flatnonzero(is_monster[notes["key"]])
+        self.monster_times = self.spawn_times[self.monster_rows]
+        corner = parent.absolute.bottom_right
+        self.monster_life = max(
+            (corner.x + offset.x + size.x) / self.absolute_speed for kind, size, offset in self.monsters.values()
+        )
+        parent.timeline.add(self.monster_times, self.spawn_monster, self.monster_rows.tolist())
+
+    def spawn_monster(self, row):
+        kind, size, offset = self.monsters[self.keys[self.notes["key"][row]]]
+        monster = self.pools[kind].acquire()
+        pos = self.parent.absolute.bottom_right + offset
+        if kind is DestructableWall:
+            # The block's spawned just before us, so we can tell it which wall gets smashed
+            monster.setup(self, self.spawn_times[row], size, pos, self.absolute_speed, self.spawned.get(row))
+        else:
+            monster.setup(self, self.spawn_times[row], size, pos, self.absolute_speed)
+        self.monsters_in_flight.add(monster)
 
-        # Update the position of any existing blocks
-        finished_monsters = []
-        new_monsters_in_flight = []
+    def remove(self, entity):
+        if entity not in self.monsters_in_flight:
+            return super().remove(entity)
+        self.monsters_in_flight.remove(entity)
+        entity.delete()
 
+    def clear(self):
+        super().clear()
         for monster in self.monsters_in_flight:
-            done = monster.update(music_pos)
-            if done:
-                finished_monsters.append(monster)
-                monster.delete()
-            else:
-                new_monsters_in_flight.append(monster)
-
-        self.monsters_in_flight = new_monsters_in_flight
-
-    def delete(self):
-        super().delete()
-        for monster in self.monster_starts:
             monster.delete()
+        self.monsters_in_flight = set()
+
+    def seek(self, music_pos):
+        super().seek(music_pos)
+        first = int(numpy.searchsorted(self.monster_times, music_pos - self.monster_life, side="right"))
+        last = int(numpy.searchsorted(self.monster_times, music_pos, side="right"))
+        # They're not all the same size, so some of these might already be gone. The next step will put those away
+        for row in self.monster_rows[first:last].tolist():
+            self.spawn_monster(row)
 
 
 class KingTrack(Track):
@@ -989,22 +1027,30 @@ class KingTrack(Track):
         )
         self.bl = Point(0, 250)
         self.tr = self.bl + self.size
+        self.current_pos = self.bl
         self.quad.set_vertices(self.bl, self.tr, 10)
 
-        self.bolt_starts = []
-        bolt_size = 64
-        # We also want to manage the devil positions
-        for note in self.notes:
-            # The time this wants introducing is the time that it should cross the line minus the amount of
-            # time that it will take to go from the top to the line pos
-            time = note.time - self.blast_time + parent.previous_runs + parent.gaps + self.window_after
-
-            if len(note.note) == 1 and ord(note.note) in range(ord("0"), ord("9")):
-                self.bolt_starts.append((time, note))
-
-    def update(self, t, music_pos):
-        super().update(t, music_pos)
-
+        # The number keys get a bolt thrown at the player, timed so it lands just as the block's window closes
+        is_bolt = numpy.array(
+            [len(key) == 1 and ord(key) in range(ord("0"), ord("9")) for key in self.keys], dtype=bool
+        )
+        self.bolt_rows = numpy.flatnonzero(is_bolt[notes["key"]])
+        self.bolt_times = self.block_times[self.bolt_rows] - self.blast_time + self.window_after
+        parent.timeline.add(self.bolt_times, self.launch_bolt, self.bolt_rows.tolist())
+
+    def launch_bolt(self, row, elapsed=0):
+        key = self.keys[self.notes["key"][row]]
+        self.parent.player.shoot(ord(key) - ord("0"), self.blast_time, self.spawned.get(row), elapsed)
+
+    def seek(self, music_pos):
+        """The timeline skips the launches before music_pos, so any bolts still in the air need throwing again"""
+        super().seek(music_pos)
+        first = int(numpy.searchsorted(self.bolt_times, music_pos - self.blast_time, side="right"))
+        last = int(numpy.searchsorted(self.bolt_times, music_pos, side="right"))
+        for row, launched in zip(self.bolt_rows[first:last].tolist(), self.bolt_times[first:last].tolist()):
+            self.launch_bolt(row, music_pos - launched)
+
+    def place_ghost(self, music_pos):
         # We want to oscillate our position
         x = 32 * math.sin(16 + (music_pos * 1.2 / 1000))
         y = 32 * math.sin((music_pos * 0.8 / 1000))
@@ -1013,20 +1059,6 @@ class KingTrack(Track):
 
         self.quad.set_vertices(self.current_pos, self.tr + Point(x, y), 10)
 
-        # Launch bolts at the player at the right time
-        num_shot = 0
-        for i in range(len(self.bolt_starts)):
-            time, note = self.bolt_starts[i]
-
-            if time >= music_pos:
-                break
-
-            self.parent.player.shoot(ord(note.note) - ord("0"), self.blast_time, note.block)
-            num_shot += 1
-
-        if num_shot > 0:
-            self.bolt_starts = self.bolt_starts[num_shot:]
-
     def delete(self):
         super().delete()
         self.quad.delete()
@@ -1036,13 +1068,16 @@ class KingTrack(Track):
 
 
 class HealthBar(ui.UIElement):
+    change_duration = 250
+
     def __init__(self, parent, bl, tr, health):
         self.max_health = health
         self.health = health
         super().__init__(parent, bl, tr)
 
         self.border = ui.Border(self, Point(0, 0.5), Point(1, 1), colour=(1, 0, 0, 1))
-        self.filled_quad = drawing.Quad(globals.ui_buffer)
+        self.filled_quad = drawing.Quad(self.ui_buffer())
+        self.tween = None
         self.title = ui.TextBox(
             self,
             Point(0, 0),
@@ -1055,11 +1090,20 @@ class HealthBar(ui.UIElement):
 
         self.set_health()
 
-    def set_health(self):
+    def set_health(self, duration=0):
         bl = self.border.absolute.bottom_left
         partial = self.health / self.max_health
         size = self.border.absolute.size * Point(partial, 1)
-        self.filled_quad.set_vertices(bl, bl + size, drawing.constants.DrawLevels.ui)
+        if self.tween:
+            self.tween.cancel()
+            self.tween = None
+        if duration:
+            # Slide the bar to its new size from wherever it is now
+            self.tween = globals.tweens.rect(
+                self.filled_quad, bl, bl + size, drawing.constants.DrawLevels.ui, globals.t, duration
+            )
+        else:
+            self.filled_quad.set_vertices(bl, bl + size, drawing.constants.DrawLevels.ui)
         self.filled_quad.set_colour((1, 0, 0, 1))
 
     def reset(self):
@@ -1075,7 +1119,7 @@ class HealthBar(ui.UIElement):
         if self.health < 0:
             self.health = 0
 
-        self.set_health()
+        self.set_health(self.change_duration)
 
 
 def format_time(t):
@@ -1084,10 +1128,156 @@ def format_time(t):
     return f"{seconds:4d}.{ms:03d}"
 
 
+class Calibration(ui.HoverableBox):
+    """
+    Works out how late this player's sound and picture are. First we play a click track and they tap along to
+    what they hear, then we flash a box and they tap along to what they see. How late the taps are in each case
+    sets the audio and visual delays in the main menu.
+
+    The taps have to be timed better than the frame we got round to them in, otherwise we'd just be measuring
+    the frame rate. pygame doesn't give us the time the key went down, so while we're up the main loop keeps
+    emptying the event queue as it waits for the next frame, and stamps each tap with when it found it
+    """
+
+    line_width = 1
+    interval = 500
+    beats = 16
+    # The first few are just so they can get into the rhythm
+    count_in = 4
+    # From the start of a pass to the first beat
+    lead = 1500
+    flash_duration = 100
+    # How long we show the results for before going back to the menu
+    linger = 3000
+
+    def __init__(self, parent, bl, tr):
+        self.reserve_panel(quads=64, runs=8)
+        self.border = drawing.QuadBorder(self.arena, line_width=self.line_width)
+        super(Calibration, self).__init__(parent, bl, tr, (0.05, 0.05, 0.05, 1))
+        self.title = ui.TextBox(
+            self,
+            Point(0, 0.8),
+            Point(1, 0.95),
+            "Calibration",
+            3,
+            colour=drawing.constants.colours.white,
+            alignment=drawing.texture.TextAlignments.CENTRE,
+        )
+        self.info = ui.TextBox(
+            self,
+            Point(0, 0.6),
+            Point(1, 0.7),
+            "",
+            2,
+            colour=drawing.constants.colours.white,
+            alignment=drawing.texture.TextAlignments.CENTRE,
+        )
+        self.flash = ui.Box(self, Point(0.4, 0.2), Point(0.6, 0.5), (1, 1, 1, 1))
+        self.flash.disable()
+        self.border.set_colour(drawing.constants.colours.red)
+        self.border.set_vertices(self.absolute.bottom_left, self.absolute.top_right)
+        self.border.enable()
+        self.clicks = None
+        self.phase = None
+        self.disable()
+
+    def start(self):
+        if self.clicks is None:
+            # The mixer's signed 16 bit unless someone asked otherwise, which we don't
+            frequency, size, channels = pygame.mixer.get_init()
+            samples = calibration.click_track(self.interval, self.beats, frequency, channels)
+            self.clicks = pygame.mixer.Sound(buffer=samples.tobytes())
+        self.audio = None
+        self.enable()
+        self.begin("audio", globals.t)
+
+    def begin(self, phase, t):
+        self.phase = phase
+        self.pass_start = t + self.lead
+        self.beat_times = []
+        self.taps = []
+        self.flash_off = None
+        if phase == "audio":
+            self.info.set_text("Tap any key in time with the clicks")
+        else:
+            self.info.set_text("Now tap in time with the flashes")
+
+    def update(self, t):
+        # The main loop sleeps when nothing's going on, and we need it not to
+        globals.damaged = True
+        if self.phase == "done":
+            if t >= self.pass_start:
+                self.close()
+            return
+
+        if self.phase == "audio":
+            if not self.beat_times and t >= self.pass_start:
+                self.clicks.play()
+                start = pygame.time.get_ticks()
+                self.beat_times = [start + i * self.interval for i in range(self.beats)]
+        elif len(self.beat_times) < self.beats and t >= self.pass_start + len(self.beat_times) * self.interval:
+            # We can't show a flash until this frame goes up, so that's when it happened
+            self.beat_times.append(t)
+            self.flash.enable()
+            self.flash_off = t + self.flash_duration
+        if self.flash_off is not None and t >= self.flash_off:
+            self.flash.disable()
+            self.flash_off = None
+
+        if t < self.pass_start + (self.beats + 1) * self.interval:
+            return
+        result = calibration.estimate_offset(self.taps, self.beat_times[self.count_in :])
+        if result is None:
+            self.begin(self.phase, t)
+            self.info.set_text("That was a bit hard to follow, let's try again")
+            return
+        offset, spread, used = result
+        if self.phase == "audio":
+            self.audio = offset
+            self.begin("visual", t)
+            return
+
+        # If you hear it late you tap late, so the music needs to be further behind, whereas if you see it
+        # late we need to draw things that much ahead
+        self.parent.main_menu.set_audio_offset(-self.audio)
+        self.parent.main_menu.set_visual_offset(offset)
+        self.info.set_text(f"Sound {self.audio:.0f} ms late, picture {offset:.0f} ms late")
+        self.phase = "done"
+        self.pass_start = t + self.linger
+
+    def key_down(self, key, when):
+        if key == pygame.locals.K_ESCAPE:
+            self.clicks.stop()
+            self.close()
+        elif self.phase != "done":
+            self.taps.append(when)
+
+    def close(self):
+        self.phase = None
+        self.flash.disable()
+        self.disable()
+        self.parent.main_menu.enable()
+
+    def enable(self):
+        if not self.enabled:
+            self.root.register_ui_element(self)
+            self.show_panel()
+        self.enabled = True
+
+    def disable(self):
+        if self.enabled:
+            self.root.remove_ui_element(self)
+            self.hide_panel()
+        self.enabled = False
+
+
 class GameView(ui.UIRoot):
     text_fade_duration = 1000
     line_pos = 0.3
     gap = 1000
+    # How far the arrow keys move in practice mode, and how far before a section we start when jumping to it
+    seek_step = 5000
+    lead_in = 2000
 
     def __init__(self):
         super(GameView, self).__init__(Point(0, 0), globals.screen)
@@ -1095,15 +1285,27 @@ class GameView(ui.UIRoot):
         self.atlas = drawing.texture.TextureAtlas("atlas_0.png", "atlas.txt", extra_names=None)
         self.wall_buffer = drawing.QuadBuffer(128)
         self.wall_atlas = drawing.texture.TextureAtlas("wall_atlas_0.png", "wall_atlas.txt", extra_names=None)
+        self.wall_atlas.texture.set_repeat()
+        self.scroll = Point(0, 0)
         self.paused = False
         self.music_start = None
+        self.song_start = 0
+        self.practice = False
+        self.loop_a = self.loop_b = None
         self.main_menu = MainMenu(self, Point(0.1, 0.15), Point(0.9, 0.85))
+        self.calibration = Calibration(self, Point(0.1, 0.15), Point(0.9, 0.85))
         self.difficulty = self.main_menu.get_difficulty()
         pygame.mixer.music.load(
             os.path.join(globals.dirs.music, "Musopen_-_In_the_Hall_Of_The_Mountain_King.ogg")
         )
         # Parse the note list
         self.notes = NoteTiming(os.path.join(globals.dirs.music, "timing.txt"))
+        bake_crates(
+            self.atlas,
+            sorted(
+                {letter_from_key(key, difficulty) for key in self.notes.keys for difficulty in note_subs}
+            ),
+        )
         # We want a line across the screen to mark the point that the keys should be hit
         self.line = Line(
             self, self.get_absolute(Point(self.line_pos, 0)), self.get_absolute(Point(self.line_pos, 1))
@@ -1141,6 +1343,19 @@ class GameView(ui.UIRoot):
         self.previous_runs = 0
         self.gaps = 0
         self.gapping = 0
+        self.frame_t = 0
+        self.frame_music_pos = 0
+        self.timeline = timers.Timeline()
+        # Everything that scrolls past comes out of these and goes back when it's done, so we make the same number
+        # of things however long the song is
+        self.entities = entities.EntityStore(drawing.MotionQuadBuffer(1024))
+        self.pools = {
+            Block: Pool(Block, 48, self.atlas, self.entities),
+            Monster: Pool(Monster, 16, self.atlas, self.entities),
+            BigMonster: Pool(BigMonster, 8, self.atlas, self.entities),
+            Wall: Pool(Wall, 16, self.atlas, self.entities),
+            DestructableWall: Pool(DestructableWall, 16, self.atlas, self.entities),
+        }
         self.setup_tracks()
         self.disable()
         self.damage = [1, 2, 4, 8]
@@ -1155,7 +1370,6 @@ class GameView(ui.UIRoot):
             alignment=drawing.texture.TextAlignments.CENTRE,
         )
         self.fade_text.disable()
-        self.fading_text = False
 
     def setup_player(self):
         if self.player:
@@ -1172,25 +1386,30 @@ class GameView(ui.UIRoot):
         for track in self.tracks:
             track.delete()
             self.tracks = []
+        self.timeline.clear()
         track_width = 0.1
         self.left_track = MonsterTrack(
-            self, 0, track_width, self.notes.get_all_notes({"horn"}, self.difficulty), self.atlas
+            self, 0, track_width, self.notes.chart.select({"horn"}, self.difficulty), self.atlas
         )
 
         self.right_track = KingTrack(
             self,
             1.0 - track_width,
             track_width,
-            self.notes.get_all_notes({"strings"}, self.difficulty),
+            self.notes.chart.select({"strings"}, self.difficulty),
             self.atlas,
         )
 
         self.tracks = [self.left_track, self.right_track]
+        self.timeline.build()
 
     def quit(self, pos):
         raise SystemExit()
 
     def miss(self, block):
+        if self.practice:
+            self.miss_streak += 1
+            return
         try:
             damage = self.damage[self.miss_streak]
         except IndexError:
@@ -1208,6 +1427,7 @@ class GameView(ui.UIRoot):
             self.disable()
             self.paused = True
             pygame.mixer.music.pause()
+            globals.music_clock.pause()
 
     def hit(self, block):
         if block:
@@ -1226,7 +1446,18 @@ class GameView(ui.UIRoot):
 
         self.miss_streak = 0
 
-    def key_down(self, key):
+    def key_down(self, key, when=None):
+        if when is None:
+            when = globals.t
+        if self.calibration.enabled:
+            return self.calibration.key_down(key, when)
+
+        if key == pygame.locals.K_F11:
+            # Debug view of what we're waiting for
+            print(globals.timers)
+            print(globals.music_timers)
+            return
+
         if key == pygame.locals.K_ESCAPE:
             if self.main_menu.enabled:
                 if self.music_start is not None:
@@ -1234,14 +1465,19 @@ class GameView(ui.UIRoot):
                 else:
                     return None
             self.main_menu.start_button.set_text("Restart")
+            self.main_menu.resume_button.enable()
             self.main_menu.enable()
             self.disable()
             self.paused = True
             pygame.mixer.music.pause()
+            globals.music_clock.pause()
+            return
+
+        if self.practice and not self.paused and self.practice_key(key):
             return
 
         for track in self.tracks:
-            if track.key_down(key):
+            if track.key_down(key, when):
                 break
         else:
             self.miss(None)
@@ -1249,12 +1485,26 @@ class GameView(ui.UIRoot):
     def key_up(self, key):
         pass
 
+    def music_pos_at(self, when):
+        """
+        Where was the music at the given get_ticks time? We know where it was at the start of this frame, and
+        the clock knows how fast it's going, so the difference just needs adding on
+        """
+        return self.frame_music_pos + (when - self.frame_t) * globals.music_clock.rate
+
+    def mixer_start(self):
+        """The music position the mixer was at when we last called play"""
+        return self.previous_runs + self.main_menu.audio_offset + self.song_start
+
     def start(self, pos):
         self.main_menu.disable()
         self.enable()
         self.paused = False
 
         self.music_start = None
+        self.song_start = 0
+        self.practice = False
+        self.loop_a = self.loop_b = None
         self.health_bar.reset()
         self.miss_streak = 0
         pygame.mixer.music.stop()
@@ -1264,10 +1514,91 @@ class GameView(ui.UIRoot):
         self.setup_tracks()
         self.fade_text.disable()
 
+    def start_calibration(self, pos):
+        self.main_menu.disable()
+        self.calibration.start()
+
+    @property
+    def wants_event_times(self):
+        """Does input need timing more closely than once a frame? It does whenever there's anything to hit"""
+        return not self.paused or self.calibration.enabled
+
+    @property
+    def idle(self):
+        """Is there nothing going on unless someone does something?"""
+        return self.paused and not self.calibration.enabled
+
+    def start_practice(self, pos):
+        """
+        Like a normal game except you can't die, the arrow keys jump around and page up and down go between
+        sections. F5 and F6 set the start and end of a bit to loop, and F7 stops looping
+        """
+        self.start(pos)
+        self.practice = True
+
+    def chart_pos(self):
+        """How far through the chart we are"""
+        return globals.music_pos - self.previous_runs
+
+    def seek(self, pos):
+        """
+        Jump straight to pos ms into the chart, without having to play up to it. The tracks, the timeline and
+        the music all get moved, and the player starts afresh
+        """
+        if self.gapping:
+            # Between runs the tracks are set up for the next one, so there's nothing sensible to seek in
+            return
+        pos = max(pos, 0)
+        audio_offset = self.main_menu.audio_offset
+        self.song_start = max(pos - audio_offset, 0)
+        pygame.mixer.music.play(start=self.song_start / 1000)
+        self.music_start = globals.t
+        music_pos = globals.music_pos = self.mixer_start()
+        globals.music_clock.start(music_pos)
+        self.frame_t = globals.t
+        self.frame_music_pos = music_pos
+
+        self.player.reset()
+        for track in self.tracks:
+            track.seek(music_pos)
+        self.timeline.seek(music_pos)
+
+    def practice_key(self, key):
+        """Handle the keys that only do something in practice mode. Returns whether it was one of those"""
+        pos = self.chart_pos()
+        sections = self.notes.sections
+        if key == pygame.locals.K_LEFT:
+            self.seek(pos - self.seek_step)
+        elif key == pygame.locals.K_RIGHT:
+            self.seek(pos + self.seek_step)
+        elif key == pygame.locals.K_PAGEUP:
+            # Back to the start of this section, or the one before if we're already near the start of it
+            index = int(numpy.searchsorted(sections, pos - self.lead_in - 500, side="right")) - 1
+            self.seek(sections[max(index, 0)] - self.lead_in)
+        elif key == pygame.locals.K_PAGEDOWN:
+            index = int(numpy.searchsorted(sections, pos + self.lead_in, side="right"))
+            if index < len(sections):
+                self.seek(sections[index] - self.lead_in)
+        elif key == pygame.locals.K_F5:
+            self.loop_a = pos
+            if self.loop_b is not None and self.loop_b <= pos:
+                self.loop_b = None
+        elif key == pygame.locals.K_F6:
+            if self.loop_a is None:
+                self.loop_a = 0
+            if pos > self.loop_a:
+                self.loop_b = pos
+        elif key == pygame.locals.K_F7:
+            self.loop_a = self.loop_b = None
+        else:
+            return False
+        return True
+
     def resume(self, pos):
         self.main_menu.disable()
         self.enable()
         pygame.mixer.music.unpause()
+        globals.music_clock.resume()
         self.paused = False
 
     def enable(self):
@@ -1277,33 +1608,33 @@ class GameView(ui.UIRoot):
         self.health_bar.disable()
 
     def update(self, t):
-        global music_start
-
+        if self.calibration.enabled:
+            self.calibration.update(t)
         if self.paused:
             return
 
-        if self.fading_text:
-            self.fading_text = not self.fade_text.update(t)
+        globals.timers.run(t)
+        globals.tweens.update(t)
+        super().update(t)
 
+        clock = globals.music_clock
         if self.music_start is None:
-            pygame.mixer.music.play(start=music_start / 1000)
+            pygame.mixer.music.play(start=self.song_start / 1000)
             self.music_start = t
+            clock.start(self.mixer_start())
 
         self.timer.set_text(format_time(globals.music_pos - self.main_menu.audio_offset))
 
-        if self.gapping:
-            core_music_pos = t - self.gapping + self.gap
-
-            if t >= self.gapping:
-                pygame.mixer.music.play(start=music_start / 1000)
-                self.music_start = t
-                self.gapping = 0
-                self.gaps = 0
-                self.previous_runs += self.gap
-
+        # In the gap between runs there's no music to ask, and the clock just carries on by itself
         if not self.gapping:
+            # The mixer only knows how long it's been since we called play, and goes negative once it's stopped
             core_music_pos = pygame.mixer.music.get_pos()
-            if core_music_pos < 0:
+            if core_music_pos >= 0:
+                clock.sample(self.mixer_start() + core_music_pos)
+            elif self.practice:
+                # Practice doesn't get harder or end, it just goes round again
+                self.seek(0)
+            else:
                 # It looped
                 self.previous_runs += globals.music_pos - self.previous_runs
                 self.gaps += self.gap
@@ -1314,21 +1645,38 @@ class GameView(ui.UIRoot):
                     return
                 self.main_menu.set_difficulty(self.difficulty)
                 self.gapping = globals.t + self.gap
+                globals.timers.call_at(self.gapping, self.end_gap)
                 self.setup_tracks()
-                music_start = 0
-                core_music_pos = 0
+                self.song_start = 0
+                clock.start(self.mixer_start())
                 difficulty_text = self.main_menu.get_difficulty_text()
                 self.fade_text.set_text(f"{difficulty_text} Difficulty!")
                 self.fade_text.SetFade(
                     globals.t + 1000, globals.t + 3000, end_size=4, end_colour=(1, 0, 0, 0)
                 )
                 self.fade_text.enable()
-                self.fading_text = True
 
-        music_pos = globals.music_pos = (
-            self.previous_runs + core_music_pos + self.main_menu.audio_offset + music_start
-        )  # t - self.music_start
-        # print(f"{core_music_pos=} {music_pos=}")
+        # This is where the music is right now. The game itself catches up to it in fixed steps
+        self.frame_t = t
+        self.frame_music_pos = globals.music_pos = clock.pos()
+
+        if self.practice and self.loop_b is not None and self.chart_pos() >= self.loop_b:
+            self.seek(self.loop_a)
+
+    def step(self, t):
+        """
+        Move the game on to time t. This gets called at a fixed rate however fast or slow we're drawing, so
+        nothing that happens in the game depends on the frame rate
+        """
+        if self.paused:
+            return
+
+        music_pos = globals.music_pos = self.music_pos_at(t)
+        globals.music_timers.run(music_pos)
+        self.timeline.run(music_pos)
+        # Everything that scrolls gets moved at once, and whatever's gone off the left goes back where it came from
+        for entity in self.entities.update(music_pos):
+            entity.track.remove(entity)
 
         # new_notes = list(self.notes.get_notes(music_pos))
         # if new_notes:
@@ -1340,25 +1688,50 @@ class GameView(ui.UIRoot):
 
         #     # These notes go into the "can-be-pressed list"
 
-        for track in self.tracks:
-            track.update(t, music_pos)
-
+        # Starting, opening and closing blocks all come off the timeline and the entity store moves them, so
+        # all that's left is the ghost, which the bolts need to know where to aim at
+        self.right_track.place_ghost(music_pos)
         self.player.update(music_pos)
 
+    def pose(self, t):
+        """
+        Put everything where it should be drawn at time t, which is somewhere between the last two steps. This
+        only moves things around, it never changes what's going on
+        """
+        if self.paused:
+            return
+
+        # The picture takes a while to get to the screen, so we show things where they'll be by then
+        music_pos = self.music_pos_at(t) + self.main_menu.visual_offset
+        self.entities.pose(music_pos)
+        self.right_track.place_ghost(music_pos)
+        self.player.pose(music_pos)
+
+        # The wall texture repeats, so scrolling it is just an offset for the shader
         speed = self.left_track.speed
         tc_max = self.dungeon.start_tc[2][0]
-        extra = ((speed * music_pos * tc_max) / 1000) % (1.0)
-        for i in range(4):
-            new = self.dungeon.start_tc[i][0] + extra
-            self.dungeon.quad.tc[i][0] = new
+        self.scroll = Point(((speed * music_pos * tc_max) / 1000) % (1.0), 0)
+        # None of that touches the buffers, so we have to say we've moved ourselves
+        globals.damaged = True
+
+    def end_gap(self):
+        pygame.mixer.music.play(start=self.song_start / 1000)
+        self.music_start = globals.t
+        self.gapping = 0
+        self.gaps = 0
+        self.previous_runs += self.gap
 
     def draw(self):
         drawing.draw_no_texture(globals.ui_buffer)
-        drawing.draw_all(self.wall_buffer, self.wall_atlas.texture)
+        drawing.draw_all(self.wall_buffer, self.wall_atlas.texture, tc_offset=self.scroll)
         drawing.draw_all(globals.quad_buffer, self.atlas.texture)
+        self.entities.draw(self.atlas.texture)
         drawing.line_width(3)
         drawing.draw_no_texture(globals.line_buffer)
 
+        for item in self.drawable_children:
+            item.draw()
+
     def mouse_motion(self, pos, rel, handled):
         if self.paused:
             return super(GameView, self).mouse_motion(pos, rel, handled)
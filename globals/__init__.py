@@ -11,3 +11,15 @@ dragging              = None
 player_config         = None
 screen_root           = None
 time                  = 0
+timers                = None
+music_timers          = None
+music_clock           = None
+tweens                = None
+refresh_rate          = 120  # 60/120/144/240, or 0 to draw as fast as we can
+vsync                 = False  # let the display pace frames instead of refresh_rate
+sim_rate              = 240  # the game moves on in fixed steps this many times a second
+damaged               = True  # has anything that gets drawn changed since the last frame?
+focused               = True
+idle_wait             = 250  # longest we sleep for in menus when nothing's changing, in ms
+unfocused_wait        = 100  # ms between frames when the window doesn't have focus
+gpu_motion            = True  # move the blocks and monsters in the vertex shader rather than on the CPU
@@ -0,0 +1,72 @@
+import collections
+
+
+class Judge(object):
+    """
+    Keeps track of which notes can be hit right now. Each key has a deque of the notes that are open for it, in
+    the order they should be hit, and since notes open and close in that same order (the Timeline sees to that)
+    closing one is just taking it off the front.
+
+    Notes that get hit are only marked as done rather than dug out of the middle of the deque; they get thrown
+    away when they reach the front. Nothing stays in there for longer than its window, so there are never more
+    than a handful to look through however dense the chart is
+    """
+
+    def __init__(self, window_before, window_after):
+        self.window_before = window_before
+        self.window_after = window_after
+        self.clear()
+
+    def clear(self):
+        self.queues = {}
+
+    def open(self, key, time, item):
+        """item can be hit with key, and ideally should be at time. It has to be opened after any before it"""
+        # Entries are (time, item, still open)
+        self.queues.setdefault(key, collections.deque()).append([time, item, True])
+
+    def close(self, key, item):
+        """item's window is over, whether or not it got hit"""
+        queue = self.queues.get(key)
+        if not queue:
+            return
+        self.tidy(queue)
+        if queue and queue[0][1] is item:
+            queue.popleft()
+            return
+        # Only if someone opened things out of order, but don't leave it hittable
+        for entry in queue:
+            if entry[1] is item:
+                entry[2] = False
+
+    def hit(self, key, music_pos):
+        """
+        Someone pressed key at music_pos. If there's an open note for it within its window we mark the closest one
+        as done and return it, otherwise None
+        """
+        queue = self.queues.get(key)
+        if not queue:
+            return None
+        self.tidy(queue)
+
+        # They're in time order, so we're getting closer until we aren't
+        best = None
+        for entry in queue:
+            if not entry[2]:
+                continue
+            offset = music_pos - entry[0]
+            if best is not None and abs(offset) >= abs(best_offset):
+                break
+            best, best_offset = entry, offset
+        if best is None:
+            return None
+
+        window = self.window_before if best_offset < 0 else self.window_after
+        if abs(best_offset) >= window:
+            return None
+        best[2] = False
+        return best[1]
+
+    def tidy(self, queue):
+        while queue and not queue[0][2]:
+            queue.popleft()
@@ -5,6 +5,9 @@ import drawing
 from globals.types import Point
 import game
 import sys
+import timers
+import clock
+import time
 
 
 def init():
@@ -19,7 +22,7 @@ def init():
     globals.screen_root = ui.UIRoot(Point(0, 0), globals.screen)
     globals.ui_state = ui.UIState()
 
-    globals.quad_buffer = drawing.QuadBuffer(131072)
+    globals.quad_buffer = drawing.QuadBuffer(131072, transforms=True)
     globals.nonstatic_text_buffer = drawing.QuadBuffer(131072)
     globals.screen_quadbuffer = drawing.QuadBuffer(16)
 
@@ -30,6 +33,12 @@ def init():
     globals.line_buffer = drawing.LineBuffer(131072)
     # globals.sounds = sounds.Sounds()
     globals.music_pos = 0
+    # Things that want to happen at a given frame time or music position respectively
+    globals.timers = timers.Scheduler("t")
+    globals.music_timers = timers.Scheduler("music_pos")
+    # Where the music is, smoothed out from what the mixer tells us
+    globals.music_clock = clock.MusicClock()
+    globals.tweens = drawing.tweens.TweenEngine()
 
     globals.mouse_relative_text = drawing.QuadBuffer(1024, ui=True, mouse_relative=True)
 
@@ -38,7 +47,7 @@ def init():
 
     pygame.mixer.init(frequency=48000, allowedchanges=0)
     # pygame.init()
-    screen = pygame.display.set_mode((w, h), pygame.OPENGL | pygame.DOUBLEBUF)
+    screen = pygame.display.set_mode((w, h), pygame.OPENGL | pygame.DOUBLEBUF, vsync=int(globals.vsync))
     pygame.display.set_caption("To the Beat of the Mountain King")
     # pygame.mouse.set_visible(False)
     drawing.init(*globals.screen)
@@ -51,24 +60,67 @@ def main_run():
 
     done = False
     last = 0
-    clock = pygame.time.Clock()
+    last_cpu = time.process_time()
+    frames = 0
+    pacer = timers.FramePacer(globals.refresh_rate, globals.vsync)
+    step = 1000 / globals.sim_rate
+    sim_t = pygame.time.get_ticks()
     last_handled = False
 
     while not done:
-
-        clock.tick(120)
+        stamps = None
+        if not globals.focused:
+            # Nobody's looking so there's no rush, but the music doesn't stop so we do have to keep going
+            events = wait_for_events(globals.unfocused_wait)
+        elif globals.current_view.idle and not globals.damaged:
+            # Nothing's moving, so drawing the same picture again would be a waste. Sleep until something happens
+            events = wait_for_events(globals.idle_wait)
+        elif globals.current_view.wants_event_times:
+            # Keep emptying the queue while we wait, so that each event is timed to within a couple of ms
+            stamped = []
+            pacer.wait(lambda: stamp_events(stamped))
+            events = [event for event, when in stamped]
+            stamps = [when for event, when in stamped]
+        else:
+            pacer.wait()
+            events = pygame.event.get()
+        # Handle input before we work out where the music is, so a slow frame doesn't hold it up
+        done, last_handled = handle_events(events, last_handled, stamps)
+        if done:
+            break
         t = pygame.time.get_ticks()
-        fps = clock.get_fps()
         if t - last > 1000:
-            print("FPS:", fps)
+            cpu = time.process_time()
+            print(
+                f"FPS: {frames * 1000 / (t - last):.1f} CPU: {(cpu - last_cpu) * 100000 / (t - last):.0f}% "
+                f"{globals.music_clock}"
+            )
             last = t
+            last_cpu = cpu
+            frames = 0
 
         globals.t = t
-        if fps == 0:
-            fps = 50
 
-        drawing.new_frame()
         globals.current_view.update(t)
+
+        # The game moves on in fixed steps up to now. If we've got really far behind (we were paused, or
+        # something stalled) then don't bother trying to simulate all of the missing time
+        if t - sim_t > 250:
+            sim_t = t - step
+        while sim_t + step <= t:
+            sim_t += step
+            globals.current_view.step(sim_t)
+        # Now we're somewhere between the last step and the next one, so draw things part way between the last
+        # two steps
+        globals.current_view.pose(t - step)
+
+        # Anything that's moved this frame gets laid out once before we draw it
+        globals.screen_root.layout_pass()
+        globals.current_view.layout_pass()
+        if not globals.damaged:
+            continue
+
+        drawing.new_frame()
         globals.current_view.draw()
         globals.screen_root.draw()
         globals.text_manager.draw()
@@ -80,61 +132,120 @@ def main_run():
         # drawing.draw_ui()
 
         pygame.display.flip()
-
-        eventlist = pygame.event.get()
-        for event in eventlist:
-            if event.type == pygame.locals.QUIT:
-                done = True
-                break
-
-            elif event.type == pygame.KEYDOWN:
-                try:
-                    key = ord(event.unicode)
-                except (AttributeError, TypeError):
-                    key = event.key
-
-                globals.current_view.key_down(key)
-            elif event.type == pygame.KEYUP:
-                try:
-                    key = ord(event.unicode)
-                except AttributeError:
-                    key = event.key
-                except TypeError:
-                    continue
-                globals.current_view.key_up(key)
-            else:
-                try:
-                    pos = Point(event.pos[0], globals.screen[1] - event.pos[1])
-                except AttributeError:
-                    continue
-                if event.type == pygame.MOUSEMOTION:
-                    rel = Point(event.rel[0], -event.rel[1])
-                    globals.mouse_screen = pos
-                    if globals.dragging:
-                        globals.dragging.mouse_motion(pos, rel, False)
-                    else:
-                        handled = globals.screen_root.mouse_motion(pos, rel, False)
-                        # Only cancel the mouse motion if wasn't cancelled already
-                        if handled and not last_handled:
-                            globals.current_view.cancel_mouse_motion()
-                        last_handled = handled
-                        globals.current_view.mouse_motion(pos, rel, True if handled else False)
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    for layer in globals.screen_root, globals.current_view:
-                        handled, dragging = layer.mouse_button_down(pos, event.button)
-                        if handled and dragging:
-                            globals.dragging = dragging
-                            break
-                        if handled:
-                            break
-
-                elif event.type == pygame.MOUSEBUTTONUP:
-                    for layer in globals.screen_root, globals.current_view:
-                        handled, dragging = layer.mouse_button_up(pos, event.button)
-                        if handled and not dragging:
-                            globals.dragging = None
-                        if handled:
-                            break
+        globals.damaged = False
+        frames += 1
+
+
+def wait_for_events(timeout):
+    """Sleep until something happens or timeout ms have gone by, and return all the events there are"""
+    event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return []
+    return [event] + pygame.event.get()
+
+
+def stamp_events(stamped):
+    """Take everything that's in the queue and say it happened now"""
+    now = pygame.time.get_ticks()
+    stamped.extend((event, now) for event in pygame.event.get())
+
+
+def handle_events(events, last_handled, stamps=None):
+    """stamps, if we have them, are when each of the events happened, from stamp_events"""
+    # All the mouse motion in a frame gets rolled into one event, so the hover logic runs at most once
+    motion = None
+    for i, event in enumerate(events):
+        if event.type == pygame.locals.QUIT:
+            return True, last_handled
+
+        elif event.type == pygame.MOUSEMOTION:
+            pos = Point(event.pos[0], globals.screen[1] - event.pos[1])
+            rel = Point(event.rel[0], -event.rel[1])
+            if motion is not None:
+                rel = rel + motion[1]
+            motion = (pos, rel)
+            continue
+
+        if motion is not None:
+            # Anything else could depend on where the mouse is, so catch up on the motion first
+            last_handled = mouse_motion(*motion, last_handled)
+            motion = None
+
+        if event.type == pygame.WINDOWFOCUSLOST:
+            globals.focused = False
+        elif event.type == pygame.WINDOWFOCUSGAINED:
+            globals.focused = True
+            globals.damaged = True
+        elif event.type == pygame.WINDOWEXPOSED:
+            # Something was covering us up, so what's on the screen might not be our last frame any more
+            globals.damaged = True
+        elif event.type == pygame.KEYDOWN:
+            try:
+                key = ord(event.unicode)
+            except (AttributeError, TypeError):
+                key = event.key
+
+            globals.current_view.key_down(key, stamps[i] if stamps else event_time(event))
+        elif event.type == pygame.KEYUP:
+            try:
+                key = ord(event.unicode)
+            except AttributeError:
+                key = event.key
+            except TypeError:
+                continue
+            globals.current_view.key_up(key)
+        else:
+            try:
+                pos = Point(event.pos[0], globals.screen[1] - event.pos[1])
+            except AttributeError:
+                continue
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                for layer in globals.screen_root, globals.current_view:
+                    handled, dragging = layer.mouse_button_down(pos, event.button)
+                    if handled and dragging:
+                        globals.dragging = dragging
+                        break
+                    if handled:
+                        break
+
+            elif event.type == pygame.MOUSEBUTTONUP:
+                for layer in globals.screen_root, globals.current_view:
+                    handled, dragging = layer.mouse_button_up(pos, event.button)
+                    if handled and not dragging:
+                        globals.dragging = None
+                    if handled:
+                        break
+
+    if motion is not None:
+        last_handled = mouse_motion(*motion, last_handled)
+
+    return False, last_handled
+
+
+def event_time(event):
+    """
+    When did this event actually happen, in get_ticks time? SDL stamps events when they arrive, which would be
+    better than the frame they get handled in, but the pygame we're pinned to (2.3) doesn't pass that on for key
+    events, so this is usually just now. Anything that needs better than that has to use stamp_events
+    """
+    timestamp = getattr(event, "timestamp", None)
+    if timestamp is None:
+        return pygame.time.get_ticks()
+    return timestamp
+
+
+def mouse_motion(pos, rel, last_handled):
+    globals.mouse_screen = pos
+    if globals.dragging:
+        globals.dragging.mouse_motion(pos, rel, False)
+        return last_handled
+
+    handled = globals.screen_root.mouse_motion(pos, rel, False)
+    # Only cancel the mouse motion if wasn't cancelled already
+    if handled and not last_handled:
+        globals.current_view.cancel_mouse_motion()
+    globals.current_view.mouse_motion(pos, rel, True if handled else False)
+    return handled
 
 
 def main():
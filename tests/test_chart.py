@@ -0,0 +1,21 @@
+import pytest
+
+import chart
+
+
+def write(tmp_path, text):
+    filename = tmp_path / "timing.txt"
+    filename.write_text(text)
+    return str(filename)
+
+
+def test_interval_fills_in_notes(tmp_path):
+    filename = write(tmp_path, "1000, 100, bass, a, 0\n+2/4\n2000, 100, bass, b, 0\n")
+    notes = chart.compile_chart(filename).notes
+    assert notes["time"].tolist() == [1000, 1250, 2000]
+
+
+def test_interval_before_first_note(tmp_path):
+    filename = write(tmp_path, "# comment\n+2/4\n1000, 100, bass, a, 0\n")
+    with pytest.raises(ValueError, match=":2:"):
+        chart.compile_chart(filename)
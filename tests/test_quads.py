@@ -0,0 +1,21 @@
+import pytest
+
+# drawing pulls in the GL bindings as soon as it's imported
+pytest.importorskip("OpenGL")
+
+import drawing
+import globals
+
+
+def test_colour_change_marks_damaged():
+    quad = drawing.Quad(drawing.QuadBuffer(16))
+    globals.damaged = False
+    quad.set_colour((1, 0, 0, 1))
+    assert globals.damaged
+
+
+def test_colours_change_marks_damaged():
+    quad = drawing.Quad(drawing.QuadBuffer(16))
+    globals.damaged = False
+    quad.set_colours([(1, 0, 0, 1)] * 4)
+    assert globals.damaged
@@ -0,0 +1,193 @@
+import heapq
+import time
+
+import numpy
+
+
+class Timer(object):
+    """
+    A callback that a Scheduler will make at a given time. Hang on to it if you might want to cancel it
+    """
+
+    def __init__(self, when, seq, callback, args, name):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.name = name if name is not None else getattr(callback, "__qualname__", repr(callback))
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def pending(self):
+        return not (self.cancelled or self.done)
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+
+class Scheduler(object):
+    """
+    Call things back at the time they ask for, rather than everything checking a deadline every frame. The
+    timers are kept in a heap so each frame only looks at the ones that are actually due, and waiting ones cost
+    nothing.
+
+    There's nothing here that knows what the time is; whoever owns the scheduler calls run with the current
+    time, whether that's the frame time or the music position. Cancelled timers are just marked and thrown
+    away when they get to the top of the heap
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.heap = []
+        self.count = 0
+        self.now = 0
+
+    def call_at(self, when, callback, *args, name=None):
+        timer = Timer(when, self.count, callback, args, name)
+        self.count += 1
+        heapq.heappush(self.heap, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args, name=None):
+        return self.call_at(self.now + delay, callback, *args, name=name)
+
+    def run(self, now):
+        """Make all the callbacks that are due by now, in the order they were due"""
+        self.now = now
+        heap = self.heap
+        while heap and heap[0].when <= now:
+            timer = heapq.heappop(heap)
+            if timer.cancelled:
+                continue
+            timer.done = True
+            timer.callback(*timer.args)
+
+    def clear(self):
+        for timer in self.heap:
+            timer.cancel()
+        self.heap = []
+
+    def pending(self):
+        return sorted(timer for timer in self.heap if timer.pending)
+
+    def __len__(self):
+        return sum(1 for timer in self.heap if timer.pending)
+
+    def __repr__(self):
+        out = [f"Scheduler {self.name} at {self.now}:"]
+        for timer in self.pending():
+            out.append(f"  {timer.when:>10.1f} (in {timer.when - self.now:.1f}) {timer.name}")
+        return "\n".join(out)
+
+
+class Timeline(object):
+    """
+    Everything that's going to happen in a song, known up front. Things get added in batches of (times,
+    handler, items), then it's all sorted once into arrays, and from then on each step only looks at the events
+    that have come due since the last one; there's a single cursor and a binary search, so it doesn't matter
+    how long the song is.
+
+    Events that come due at the same time happen in the order they were added
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.batches = []
+        self.times = numpy.zeros(0, numpy.float64)
+        self.handlers = numpy.zeros(0, numpy.int32)
+        self.items = numpy.zeros(0, numpy.int32)
+        self.cursor = 0
+
+    def add(self, times, handler, items):
+        """handler gets called with each of items when music_pos gets to the matching time"""
+        items = list(items)
+        if len(items) != len(times):
+            raise ValueError("Need one time per item")
+        self.batches.append((numpy.asarray(times, numpy.float64), handler, items))
+
+    def build(self):
+        """Sort everything that's been added. Needs calling before run"""
+        if not self.batches:
+            self.clear()
+            return
+        times = numpy.concatenate([times for times, handler, items in self.batches])
+        handlers = numpy.concatenate(
+            [numpy.full(len(times), i, numpy.int32) for i, (times, handler, items) in enumerate(self.batches)]
+        )
+        items = numpy.concatenate(
+            [numpy.arange(len(times), dtype=numpy.int32) for times, handler, items in self.batches]
+        )
+        order = numpy.argsort(times, kind="stable")
+        self.times = times[order]
+        self.handlers = handlers[order]
+        self.items = items[order]
+        self.cursor = 0
+
+    def seek(self, now):
+        """Skip to now without calling anything; whoever's seeking has to sort out what should have happened"""
+        self.cursor = int(numpy.searchsorted(self.times, now, side="right"))
+
+    def run(self, now):
+        """Call the handlers for everything that's due by now, in time order"""
+        end = int(numpy.searchsorted(self.times, now, side="right"))
+        if end <= self.cursor:
+            return
+        start, self.cursor = self.cursor, end
+        batches = self.batches
+        for handler, item in zip(self.handlers[start:end].tolist(), self.items[start:end].tolist()):
+            batch = batches[handler]
+            batch[1](batch[2][item])
+
+
+class FramePacer(object):
+    """
+    Keeps the frames coming at the refresh rate. If the display is doing vsync then flip already waits for the
+    right moment and there's nothing for us to do. Otherwise we sleep until just before the next frame is due
+    and then spin for the last little bit, which is a lot more even than Clock.tick's sleep. A rate of 0 means
+    go as fast as we can
+    """
+
+    spin = 0.002
+    # How often we call poll while we're sleeping
+    poll_interval = 0.001
+
+    def __init__(self, rate, vsync=False):
+        self.vsync = vsync
+        self.set_rate(rate)
+        self.next = time.perf_counter()
+
+    def set_rate(self, rate):
+        self.interval = 1 / rate if rate else 0
+
+    def wait(self, poll=None):
+        """
+        Wait for the next frame. If there's a poll it gets called every ms or so while we wait, for anything
+        that needs to know when things happen more closely than once a frame. With vsync we don't wait here, so
+        it only gets called the once
+        """
+        now = time.perf_counter()
+        if self.interval and not self.vsync:
+            self.next += self.interval
+            if self.next < now:
+                # We've fallen behind, don't try and make up for it with a burst of short frames
+                self.next = now
+            elif poll is None:
+                if self.next - now > self.spin:
+                    time.sleep(self.next - now - self.spin)
+                while time.perf_counter() < self.next:
+                    pass
+            else:
+                while self.next - time.perf_counter() > self.spin:
+                    poll()
+                    time.sleep(self.poll_interval)
+                poll()
+                while time.perf_counter() < self.next:
+                    pass
+        if poll is not None:
+            poll()
@@ -4,6 +4,7 @@ from globals.types import Point
 import bisect
 import pygame
 import copy
+import numpy
 
 
 class UIState(object):
@@ -16,18 +17,40 @@ class UIState(object):
 
 class UIElementList:
     """
-    Very basic implementation of a list of UIElements that can be looked up by position.
-    It's using an O(n) algorithm, and I'm sure I can do better once everything's working
+    A list of UIElements that can be looked up by position. The screen is split into a uniform grid of cells,
+    and each element is put in every cell that its absolute bounds touch, so finding what's under the mouse
+    only needs to look at the handful of elements in one cell. Each cell is kept ordered by level (highest
+    first, then by when they were registered) so the first selectable match is the one we want.
+
+    Elements are keyed by identity, and it's up to the element to call update when it moves (set_bounds does
+    this) so that it's put in the right cells
     """
 
+    cell_size = 128
+
     def __init__(self):
         self.items = {}
+        # For each item, its sort key and the range of cells it's in
+        self.entries = {}
+        self.cells = {}
+        self.count = 0
 
     def __setitem__(self, item, value):
+        if item in self.items:
+            if self.items[item] == value:
+                return
+            # Keep its place in the order for things on the same level
+            seq = self.entries[item][0][1]
+            self.remove(item)
+        else:
+            seq = self.count
+            self.count += 1
         self.items[item] = value
+        self.add(item, (-value, seq))
 
     def __delitem__(self, item):
         del self.items[item]
+        self.remove(item)
 
     def __contains__(self, item):
         return item in self.items
@@ -49,14 +72,54 @@ class UIElementList:
             )
         return "\n".join(out)
 
+    def cell_range(self, item):
+        bl = item.absolute.bottom_left
+        tr = item.absolute.top_right
+        return (
+            int(min(bl.x, tr.x) // self.cell_size),
+            int(min(bl.y, tr.y) // self.cell_size),
+            int(max(bl.x, tr.x) // self.cell_size),
+            int(max(bl.y, tr.y) // self.cell_size),
+        )
+
+    def add(self, item, key, cells=None):
+        if cells is None:
+            cells = self.cell_range(item)
+        self.entries[item] = (key, cells)
+        entry = (key, item)
+        for x in range(cells[0], cells[2] + 1):
+            for y in range(cells[1], cells[3] + 1):
+                cell = self.cells.setdefault((x, y), [])
+                # The keys are unique so bisect never has to compare the items themselves
+                cell.insert(bisect.bisect_right(cell, (key,)), entry)
+
+    def remove(self, item):
+        key, cells = self.entries.pop(item)
+        for x in range(cells[0], cells[2] + 1):
+            for y in range(cells[1], cells[3] + 1):
+                cell = self.cells[x, y]
+                del cell[bisect.bisect_left(cell, (key,))]
+                if not cell:
+                    del self.cells[x, y]
+
+    def update(self, item):
+        """The item has moved or changed size, so make sure it's in the right cells"""
+        try:
+            key, cells = self.entries[item]
+        except KeyError:
+            return
+        new_cells = self.cell_range(item)
+        if new_cells != cells:
+            self.remove(item)
+            self.add(item, key, new_cells)
+
     def get(self, pos):
         """Return the object at a given absolute position, or None if None exist"""
-        match = [-1, None]
-        for ui, height in self.items.items():
+        cell = self.cells.get((int(pos.x // self.cell_size), int(pos.y // self.cell_size)), ())
+        for key, ui in cell:
             if pos in ui and ui.selectable():
-                if height > match[0]:
-                    match = [height, ui]
-        return match[1]
+                return ui
+        return None
 
 
 class AbsoluteBounds(object):
@@ -88,8 +151,13 @@ class UIElement(object):
     When a UIElements's position or size changes, it updates all of its children so they can work out their
     new position and size
 
+    Elements that are panels (see reserve_panel) have their own arena of the ui buffer and their own glyph run
+    buffer, and everything below them draws into those, so the whole panel can be hidden in one go
     """
 
+    arena = None
+    text_runs = None
+
     def __init__(self, parent, pos, tr):
         self.parent = parent
         self.absolute = AbsoluteBounds()
@@ -99,6 +167,7 @@ class UIElement(object):
         self.get_absolute_in_parent = parent.get_absolute
         self.root = parent.root
         self.level = parent.level + 1
+        self.panel = self if self.arena is not None else parent.panel
         self.set_bounds(pos, tr)
         self.enabled = False
         self.dragging = None
@@ -110,11 +179,24 @@ class UIElement(object):
         self.bottom_left = pos
         self.top_right = tr
         self.size = tr - pos
+        self.root.active_children.update(self)
 
     def update_position(self):
+        """
+        Something about our geometry has changed, so we and everything below us need laying out again. That
+        doesn't happen straight away; the root does one layout pass before drawing, so moving something lots of
+        times in a frame, or moving a parent and a bunch of its children, only lays out each element once
+        """
+        self.root.mark_layout_dirty(self)
+
+    def update_layout(self):
+        """
+        Called by the root's layout pass to work out our absolute position again from our parent's, and then
+        our children's. Subclasses that put things in buffers should update them here
+        """
         self.set_bounds(self.bottom_left, self.top_right)
         for child_element in self.children:
-            child_element.update_position()
+            child_element.update_layout()
 
     def set_pos(self, pos):
         """Called by the user to update our position directly"""
@@ -217,7 +299,32 @@ class UIElement(object):
             return True
 
     def selectable(self):
-        return self.on
+        return self.on and (self.panel is None or self.panel.panel_shown())
+
+    def reserve_panel(self, quads, runs):
+        """
+        Make this element a panel, with room for the given number of quads and text runs for it and everything
+        below it. This needs calling before UIElement.__init__
+        """
+        self.arena = globals.ui_buffer.reserve(quads)
+        self.text_runs = globals.text_manager.new_panel_runs(runs)
+
+    def ui_buffer(self):
+        """Where quads for this element should come from"""
+        return self.panel.arena if self.panel else globals.ui_buffer
+
+    def panel_shown(self):
+        if self.arena.hidden:
+            return False
+        return self.parent.panel is None or self.parent.panel.panel_shown()
+
+    def show_panel(self):
+        self.arena.show()
+        self.text_runs.hidden = False
+
+    def hide_panel(self):
+        self.arena.hide()
+        self.text_runs.hidden = True
 
     def disable(self):
         for child in self.children:
@@ -231,6 +338,8 @@ class UIElement(object):
 
     def delete(self):
         self.disable()
+        # Whatever we had is about to go to someone else, so a layout pass mustn't write to it
+        self.root.forget_layout(self)
         for child in self.children:
             child.delete()
 
@@ -244,9 +353,6 @@ class UIElement(object):
         for child in self.children:
             child.make_unselectable()
 
-    def __hash__(self):
-        return hash((self.absolute.bottom_left, self.absolute.top_right, self.level))
-
 
 class RootElement(UIElement):
     """
@@ -262,9 +368,13 @@ class RootElement(UIElement):
         self.get_absolute_in_parent = lambda x: x
         self.root = self
         self.level = 0
+        self.panel = None
         self.hovered = None
         self.children = []
         self.active_children = UIElementList()
+        self.dirty_layout = {}
+        self.laying_out = {}
+        self.in_layout = False
         self.depressed = None
         self.cheats = ()
         self.set_bounds(bl, tr)
@@ -278,13 +388,47 @@ class RootElement(UIElement):
         except KeyError:
             pass
 
+    def mark_layout_dirty(self, element):
+        # Anything that gets moved while we're laying out is going to be dealt with by the pass anyway
+        if not self.in_layout:
+            self.dirty_layout[element] = True
+
+    def forget_layout(self, element):
+        """element has been deleted, so it shouldn't be laid out even if it's in the middle of a pass"""
+        self.dirty_layout.pop(element, None)
+        self.laying_out.pop(element, None)
+
+    def layout_pass(self):
+        """
+        Lay out everything that's been marked as changed since last time. Parents go before their children,
+        and an element whose ancestor is also dirty is skipped as it'll be done as part of that subtree
+        """
+        if not self.dirty_layout:
+            return
+        dirty = self.laying_out = self.dirty_layout
+        self.dirty_layout = {}
+        self.in_layout = True
+        try:
+            for element in sorted(dirty, key=lambda element: element.level):
+                if element not in dirty:
+                    # Deleted by something earlier in the pass
+                    continue
+                parent = getattr(element, "parent", None)
+                while parent is not None and parent not in dirty:
+                    parent = getattr(parent, "parent", None)
+                if parent is None:
+                    element.update_layout()
+        finally:
+            self.in_layout = False
+            self.laying_out = {}
+
     def remove_all_ui_elements(self):
         toremove = [child for child in self.active_children.items]
         for child in toremove:
             child.delete()
         self.active_children = UIElementList()
 
-    def key_down(self, key):
+    def key_down(self, key, when=None):
         #        if key == pygame.locals.K_RETURN:
         #            if self.current_player.is_player():
         #                self.current_player.end_turn(Point(0,0))
@@ -394,27 +538,15 @@ class UIRoot(RootElement):
     def update(self, t):
         """
         When we have updateable children, they can indicate to us that they are complete,
-        which allows us to stop updating them and save time
+        which allows us to stop updating them and save time. Anything that's just waiting for a particular
+        time should get globals.timers to register it when it's due rather than sit in here
         """
-        # self.updateable_children = {item : value for item,value in self.updateable_children.iteritems() if (not item.enabled or not item.update(t))}
-        new_children = {}
-        for item, value in list(self.updateable_children.items()):
-            complete = False
-            if item.enabled:
-                complete = item.update(t)
-            if not complete:
-                new_children[item] = value
-        self.updateable_children = new_children
-        # to_remove = []
-        # for item in self.updateable_children:
-        #     if item.enabled:
-        #         complete = item.update(t)
-        #         if complete:
-        #             to_remove.append(item)
-        # print to_remove
-        # if len(to_remove) > 0:
-        #     for item in to_remove:
-        #         self.remove_updatable(item)
+        complete = []
+        for item in list(self.updateable_children):
+            if item.enabled and item.update(t):
+                complete.append(item)
+        for item in complete:
+            self.remove_updatable(item)
 
     def register_drawable(self, item):
         self.drawable_children[item] = True
@@ -432,9 +564,7 @@ class UIRoot(RootElement):
         try:
             del self.updateable_children[item]
         except KeyError:
-            print("failed to remove", item, "from", self.updateable_children)
-        else:
-            print("removed", item)
+            pass
 
 
 class HoverableElement(UIElement):
@@ -467,7 +597,7 @@ class Box(UIElement):
 
     def __init__(self, parent, pos, tr, colour):
         super(Box, self).__init__(parent, pos, tr)
-        self.quad = drawing.Quad(globals.ui_buffer)
+        self.quad = drawing.Quad(self.ui_buffer())
         self.colour = colour
         self.unselectable_colour = tuple(component * 0.6 for component in self.colour)
         self.quad.set_colour(self.colour)
@@ -476,9 +606,11 @@ class Box(UIElement):
         )
         self.enable()
 
-    def update_position(self):
-        super(Box, self).update_position()
-        self.quad.set_vertices(self.absolute.bottom_left, self.absolute.top_right, drawing.constants.ui_level)
+    def update_layout(self):
+        super(Box, self).update_layout()
+        self.quad.set_vertices(
+            self.absolute.bottom_left, self.absolute.top_right, drawing.constants.DrawLevels.ui
+        )
 
     def delete(self):
         super(Box, self).delete()
@@ -510,6 +642,9 @@ class HoverableBox(Box, HoverableElement):
 class TextBox(UIElement):
     """A Screen-relative text box wraps text to a given size"""
 
+    # CUSTOM text boxes set this to the GlyphRunBuffer they want their text in
+    run_buffer = None
+
     def __init__(
         self,
         parent,
@@ -543,7 +678,6 @@ class TextBox(UIElement):
         self.alignment = alignment
         self.text_manager = globals.text_manager
         self.reallocate_resources()
-        # self.quads       = [self.text_manager.letter(char,self.text_type) for char in self.text]
         self.viewpos = 0
         # that sets the texture coords for us
         self.position(self.bottom_left, self.scale, self.colour)
@@ -551,114 +685,54 @@ class TextBox(UIElement):
 
     def position(self, pos, scale, colour=None, ignore_height=False):
         """Draw the text at the given location and size. Maybe colour too"""
-        # set up the position for the characters. Note that we do everything here in size relative
-        # to our text box (so (0,0) is bottom_left, (1,1) is top_right.
         self.pos = pos
         self.absolute.bottom_left = self.get_absolute_in_parent(pos)
         self.scale = scale
-        self.lowest_y = 0
-        row_height = (
-            float(self.text_manager.font_height * self.scale * drawing.texture.global_scale)
-            / self.absolute.size.y
-        )
-        # Do this without any kerning or padding for now, and see what it looks like
-        cursor = Point(self.margin.x, -self.viewpos + 1 - row_height - self.margin.y)
-        letter_sizes = [
-            Point(
-                float(quad.width * self.scale * drawing.texture.global_scale) / self.absolute.size.x,
-                float(quad.height * self.scale * drawing.texture.global_scale) / self.absolute.size.y,
-            )
-            for quad in self.quads
-        ]
-        # for (i,(quad,letter_size)) in enumerate(zip(self.quads,letter_sizes)):
-        i = 0
-        while i < len(self.quads):
-            quad, letter_size = self.quads[i], letter_sizes[i]
-            if cursor.x + letter_size.x > (1 - self.margin.x) * 1.001:
-                # This would take us over a line. If we're in the middle of a word, we need to go back to the start of the
-                # word and start the new line there
-                restart = False
-                if quad.letter in " \t":
-                    # It's whitespace, so ok to start a new line, but do it after the whitespace
-                    try:
-                        while self.quads[i].letter in " \t":
-                            i += 1
-                    except IndexError:
-                        break
-                    restart = True
-                else:
-                    # look for the start of the word
-                    while i >= 0 and self.quads[i].letter not in " \t":
-                        i -= 1
-                    if i <= 0:
-                        # This single word is too big for the line. Shit, er, lets just bail
-                        break
-                    # skip the space
-                    i += 1
-                    restart = True
-
-                cursor.x = self.margin.x
-                cursor.y -= row_height * 1.2
-                if restart:
-                    continue
+        self.glyph_scale = scale * drawing.texture.global_scale
+        layout = self.text_manager.layout(self.text, self.scale, self.absolute.size, self.margin, self.alignment)
+        visible = layout.drawn
+        if not ignore_height:
+            # Anything that's gone below the bottom of the box has no room to be written
+            visible = visible & (layout.bl[:, 1] >= self.viewpos * self.absolute.size.y)
+        self.lowest_y = min(0, layout.lowest_y - self.viewpos)
+
+        # If all that's happened is that we've moved then the glyphs are all still right, and just moving the
+        # run is enough
+        if layout is not self.run_layout[0] or not numpy.array_equal(visible, self.run_layout[1]):
+            self.run.set_glyphs(self.glyphs[visible], layout.bl[visible] / self.glyph_scale)
+            self.run_layout = (layout, visible)
+        self.place_run()
+        if colour:
+            self.run.set_colour(colour)
+        # We've already been placed, so it's just the things inside us that need laying out again
+        self.set_bounds(self.bottom_left, self.top_right)
+        for child_element in self.children:
+            child_element.update_position()
 
-            if cursor.x == self.margin.x and self.alignment == drawing.texture.TextAlignments.CENTRE:
-                # If we're at the start of a row, and we're trying to centre the text, then check to see how full this row is
-                # and if it's not full, offset so that it becomes centred
-                width = 0
-                for size in letter_sizes[i:]:
-                    width += size.x
-                    if width > 1 - self.margin.x:
-                        width -= size.x
-                        break
-                if width > 0:
-                    cursor.x += float(1 - (self.margin.x * 2) - width) / 2
-
-            target_bl = cursor
-            target_tr = target_bl + letter_size
-            if target_bl.y < self.lowest_y:
-                self.lowest_y = target_bl.y
-            if target_bl.y < 0 and not ignore_height:
-                # We've gone too far, no more room to write!
-                break
-            absolute_bl = self.get_absolute(target_bl)
-            absolute_tr = self.get_absolute(target_tr)
-            self.set_letter_vertices(
-                i, absolute_bl, absolute_tr, drawing.texture.TextTypes.LEVELS[self.text_type]
-            )
-            if colour:
-                quad.set_colour(colour)
-            cursor.x += letter_size.x
-            i += 1
-        # For the quads that we're not using right now, set them to display nothing
-        for quad in self.quads[i:]:
-            quad.set_vertices(Point(0, 0), Point(0, 0), -10)
-        height = max([q.height for q in self.quads])
-        super(TextBox, self).update_position()
-
-    def set_letter_vertices(self, index, bl, tr, textType):
-        self.quads[index].set_vertices(bl, tr, textType)
+    def place_run(self):
+        # The layout is relative to our bottom left, and the only thing the viewpos does is slide it up or down
+        origin = self.absolute.bottom_left - Point(0, self.viewpos * self.absolute.size.y)
+        self.run.set_placement(origin, drawing.texture.TextTypes.LEVELS[self.text_type], self.glyph_scale)
 
-    def update_position(self):
-        """Called by the parent to tell us we need to recalculate our absolute position"""
-        super(TextBox, self).update_position()
+    def update_layout(self):
+        super(TextBox, self).update_layout()
         self.position(self.pos, self.scale, self.colour)
 
     def set_pos(self, pos):
         """Called by the user to update our position directly"""
+        self.pos = pos
         self.set_bounds(pos, pos + self.size)
-        self.position(pos, self.scale, self.colour)
+        # The text gets put there by the next layout pass, along with everything else that's moved
+        self.update_position()
 
     def set_colour(self, colour):
         self.colour = colour
-        for quad in self.quads:
-            quad.set_colour(colour)
+        self.run.set_colour(colour)
 
     def delete(self):
         """We're done; pack up and go home!"""
         super(TextBox, self).delete()
-        for quad in self.quads:
-            quad.delete()
+        self.run.delete()
 
     def set_text(self, text, colour=None):
         enabled = self.enabled
@@ -676,44 +750,44 @@ class TextBox(UIElement):
         self.reallocate_resources()
         self.viewpos = 0
         self.position(self.pos, self.scale, colour)
-        # Updating the quads with self.position re-enables them, so if we're disabled: don't draw
+        # We've got a brand new run which is enabled, so if we're disabled: don't draw
         if not self.enabled:
-            for q in self.quads:
-                q.disable()
+            self.run.disable()
 
     def reallocate_resources(self):
-        self.quads = [self.text_manager.letter(char, self.text_type) for char in self.text]
+        self.glyphs = self.text_manager.glyphs(self.text)
+        buffer = self.run_buffer
+        if buffer is None and self.panel:
+            buffer = self.panel.text_runs
+        self.run = self.text_manager.new_run(self.text_type, buffer)
+        self.run_layout = (None, None)
 
     def disable(self):
         if self.enabled:
-            for q in self.quads:
-                q.disable()
+            self.run.disable()
         super(TextBox, self).disable()
 
     def enable(self):
         if not self.enabled:
-            for q in self.quads:
-                q.enable()
+            self.run.enable()
         super(TextBox, self).enable()
 
 
 class FaderTextBox(TextBox):
-    """A Textbox that can be smoothly faded to a different size / colour"""
+    """
+    A Textbox that can be smoothly faded to a different size / colour. Rather than a glyph run it draws a
+    TextSprite, so the text only gets rendered once and fading it is just tweening one quad
+    """
 
     def __init__(self, *args, **kwargs):
+        self.sprite = None
+        self.fade_tweens = []
+        self.quad_buffer = drawing.QuadBuffer(1, ui=True, transforms=True)
+        self.quad = drawing.Quad(self.quad_buffer, tc=drawing.constants.full_tc)
         super(FaderTextBox, self).__init__(*args, **kwargs)
-        self.draw_scale = 1
         self.end_time = 0
         self.start_time = 0
 
-    def __hash__(self):
-        return id(self)
-
-    def set_letter_vertices(self, index, bl, tr, textType):
-        self.quads[index].set_vertices(
-            bl - self.absolute.bottom_left, tr - self.absolute.bottom_left, textType
-        )
-
     def SetFade(self, start_time, end_time, end_size, end_colour):
         self.start_time = start_time
         self.end_time = end_time
@@ -722,65 +796,117 @@ class FaderTextBox(TextBox):
         self.end_size = end_size
         self.size_difference = self.end_size - self.start_size
         self.end_colour = end_colour
-        self.draw_scale = 1
         # self.bl = (self.absolute.bottom_left - self.absolute.size*1.5).to_int()
         # self.tr = (self.absolute.top_right + self.absolute.size*1.5).to_int()
         self.colour_delay = 0.4
         # print bl,tr
         self.enable()
+        self.cancel_fade()
+        # We grow about our middle the whole time, but only start fading out once we're part way there
+        self.fade_tweens = [
+            globals.tweens.zoom(self.quad, end_size, start_time, self.duration),
+            globals.tweens.colour(
+                self.quad,
+                self.colour[:3] + (0,),
+                start_time,
+                self.duration,
+                start=self.colour,
+                easing=drawing.tweens.delayed(drawing.tweens.smoothstep, self.colour_delay),
+                callback=self.disable,
+            ),
+        ]
+
+    def cancel_fade(self):
+        for tween in self.fade_tweens:
+            tween.cancel()
+        self.fade_tweens = []
+
+    def position(self, pos, scale, colour=None, ignore_height=False):
+        self.pos = pos
+        self.absolute.bottom_left = self.get_absolute_in_parent(pos)
+        if scale != self.scale:
+            self.scale = scale
+            self.reallocate_resources()
+        self.place_sprite()
+        if colour:
+            self.quad.set_colour(colour)
+        # We've already been placed, so it's just the things inside us that need laying out again
+        self.set_bounds(self.bottom_left, self.top_right)
+        for child_element in self.children:
+            child_element.update_position()
+
+    def place_sprite(self):
+        # The sprite is the text on a single row, so put it where the first line would go
+        size = self.sprite.size
+        margin = self.margin * self.absolute.size
+        slack = max(self.absolute.size.x - margin.x * 2 - size.x, 0)
+        if self.alignment == drawing.texture.TextAlignments.RIGHT:
+            margin.x += slack
+        elif self.alignment == drawing.texture.TextAlignments.CENTRE:
+            margin.x += slack / 2
+        bl = Point(self.absolute.bottom_left.x + margin.x, self.absolute.top_right.y - margin.y - size.y)
+        self.quad.set_vertices(bl, bl + size, drawing.texture.TextTypes.LEVELS[self.text_type])
+        # Back to normal size in case we're part way through a fade
+        self.quad.set_transform()
+
+    def set_colour(self, colour):
+        self.colour = colour
+        self.quad.set_colour(colour)
+
+    def set_text(self, text, colour=None):
+        self.text = text
+        self.reallocate_resources()
+        self.position(self.pos, self.scale, colour)
+
+    def reallocate_resources(self):
+        if self.sprite:
+            self.sprite.release()
+        self.sprite = self.text_manager.sprite(self.text, self.scale)
+
+    def delete(self):
+        super(TextBox, self).delete()
+        self.quad.delete()
+        self.sprite.release()
 
     def enable(self):
         if not self.enabled:
             self.root.register_ui_element(self)
             self.root.register_drawable(self)
-            self.root.register_updateable(self)
-        super(FaderTextBox, self).enable()
+            self.quad.enable()
+        super(TextBox, self).enable()
 
     def disable(self):
         if self.enabled:
             self.root.remove_ui_element(self)
             self.root.remove_drawable(self)
-        super(FaderTextBox, self).disable()
+            # Stop before the quad is disabled, otherwise the tweens would just put it back
+            self.cancel_fade()
+            self.quad.disable()
+        super(TextBox, self).disable()
 
-    def update(self, t):
-        # print 'bbb',t,self.start_time,self.end_time
-        if t > self.end_time:
-            # self.disable()
-            return True
-        if t < self.start_time:
-            return False
-        partial = float(t - self.start_time) / self.duration
-        partial = partial * partial * (3 - 2 * partial)  # smoothstep
-        self.draw_scale = self.start_size + (self.size_difference * partial)
-        if partial > self.colour_delay:
-            new_colour = self.colour[:3] + (1 - ((partial - self.colour_delay) / (1 - self.colour_delay)),)
-            for quad in self.quads:
-                quad.set_colour(new_colour)
-
-    # def reallocate_resources(self):
-    #     self.quad_buffer = drawing.QuadBuffer(1024)
-    #     self.text_type = drawing.texture.TextTypes.CUSTOM
-    #     self.quads = [self.text_manager.letter(char, self.text_type, self.quad_buffer) for char in self.text]
-
-    # def draw(self):
-    #     drawing.reset_state()
-    #     drawing.scale(globals.tiles.zoom, globals.tiles.zoom, 1)
-    #     drawing.translate(-globals.tiles.viewpos.get().x, -globals.tiles.viewpos.get().y, 0)
-    #     drawing.translate(self.absolute.bottom_left.x, self.absolute.bottom_left.y, 0)
-    #     drawing.scale(self.draw_scale * globals.tiles.zoom, self.draw_scale * globals.tiles.zoom, 1)
-    #     drawing.draw_all(self.quad_buffer, globals.text_manager.atlas.texture)
+    def draw(self):
+        drawing.draw_all(self.quad_buffer, self.sprite.target)
 
 
 class ScrollTextBox(TextBox):
     """A TextBox that can be scrolled to see text that doesn't fit in the box"""
 
     def __init__(self, *args, **kwargs):
+        self.run_buffer = drawing.texture.GlyphRunBuffer(runs=4)
         super(ScrollTextBox, self).__init__(*args, **kwargs)
         self.dragging = None
         self.enable()
 
     def position(self, pos, scale, colour=None):
         super(ScrollTextBox, self).position(pos, scale, colour, ignore_height=True)
+        # The viewpos isn't baked into the layout, so how far we can scroll doesn't depend on it either
+        self.lowest_y = min(0, self.run_layout[0].lowest_y)
+
+    def place_run(self):
+        # The viewpos is applied when we draw, so the run always sits at the top of the box
+        self.run.set_placement(
+            self.absolute.bottom_left, drawing.texture.TextTypes.LEVELS[self.text_type], self.glyph_scale
+        )
 
     def enable(self):
         if not self.enabled:
@@ -799,32 +925,16 @@ class ScrollTextBox(TextBox):
         return self
 
     def reallocate_resources(self):
-        self.quad_buffer = drawing.QuadBuffer(1024)
         self.text_type = drawing.texture.TextTypes.CUSTOM
-        self.quads = [self.text_manager.letter(char, self.text_type, self.quad_buffer) for char in self.text]
+        super(ScrollTextBox, self).reallocate_resources()
 
     def draw(self):
-        pass
-        # glPushAttrib(GL_VIEWPORT_BIT)
-        # glMatrixMode(GL_PROJECTION)
-        # drawing.reset_state()
-        # bl = self.absolute.bottom_left.to_int()
-        # tr = self.absolute.top_right.to_int()
-        # glOrtho(bl.x, tr.x, bl.y, tr.y,-10000,10000)
-        # glMatrixMode(GL_MODELVIEW)
-        # glViewport(bl.x, bl.y, tr.x-bl.x, tr.y-bl.y)
-
-        # drawing.translate(0,-self.viewpos*self.absolute.size.y,0)
-        # glVertexPointerf(self.quad_buffer.vertex_data)
-        # glTexCoordPointerf(self.quad_buffer.tc_data)
-        # glColorPointer(4,GL_FLOAT,0,self.quad_buffer.colour_data)
-        # glDrawElements(GL_QUADS,self.quad_buffer.current_size,GL_UNSIGNED_INT,self.quad_buffer.indices)
-
-        # glMatrixMode(GL_PROJECTION)
-        # drawing.reset_state()
-        # glOrtho(0, globals.screen.x, 0, globals.screen.y,-10000,10000)
-        # glMatrixMode(GL_MODELVIEW)
-        # glPopAttrib()
+        # All the text was laid out once at the top of the box; scrolling just slides it and the scissor keeps it
+        # inside us
+        offset = Point(0, -self.viewpos * self.absolute.size.y)
+        drawing.opengl.draw_glyph_runs_clipped(
+            self.run_buffer, self.text_manager.atlas.texture, self.absolute.bottom_left, self.absolute.size, offset
+        )
 
     def undepress(self, pos):
         self.dragging = None
@@ -856,8 +966,6 @@ class ScrollTextBox(TextBox):
                 self.dragging = high_thresh
             if self.dragging < low_thresh:
                 self.dragging = low_thresh
-            # print 'stb vp:',self.viewpos
-            # self.update_position()
 
 
 class TextBoxButton(TextBox):
@@ -879,10 +987,6 @@ class TextBoxButton(TextBox):
         super(TextBoxButton, self).position(pos, scale, colour)
         self.set_vertices()
 
-    def update_position(self):
-        super(TextBoxButton, self).update_position()
-        self.set_vertices()
-
     def set_vertices(self):
         self.border.set_colour(drawing.constants.colours.red)
         self.border.set_vertices(
@@ -891,19 +995,9 @@ class TextBoxButton(TextBox):
         if not self.enabled:
             self.border.disable()
 
-    def set_pos(self, pos):
-        # FIXME: This is shit. I can't be removing and adding every frame
-        reregister = self.enabled
-        if reregister:
-            self.root.remove_ui_element(self)
-        super(TextBoxButton, self).set_pos(pos)
-        self.set_vertices()
-        if reregister:
-            self.root.register_ui_element(self)
-
     def reallocate_resources(self):
         super(TextBoxButton, self).reallocate_resources()
-        self.border = drawing.QuadBorder(globals.ui_buffer, line_width=self.line_width)
+        self.border = drawing.QuadBorder(self.ui_buffer(), line_width=self.line_width)
 
     def delete(self):
         super(TextBoxButton, self).delete()
@@ -979,7 +1073,7 @@ class Slider(UIElement):
         self.uilevel = drawing.constants.DrawLevels.ui + 1
         self.enabled = False
         self.clickable_area = UIElement(self, Point(0.05, 0), Point(0.95, 1))
-        line = drawing.Quad(globals.ui_buffer)
+        line = drawing.Quad(self.ui_buffer())
         line_bl = self.clickable_area.absolute.bottom_left + self.clickable_area.absolute.size * Point(0, 0.3)
         line_tr = line_bl + self.clickable_area.absolute.size * Point(1, 0) + Point(0, 2)
         line.set_vertices(line_bl, line_tr, self.uilevel)
@@ -992,7 +1086,7 @@ class Slider(UIElement):
         ]
         self.lines.append(line)
         self.index = 0
-        self.pointer_quad = drawing.Quad(globals.ui_buffer)
+        self.pointer_quad = drawing.Quad(self.ui_buffer())
         self.pointer_colour = (1, 0, 0, 1)
         self.lines.append(self.pointer_quad)
         self.pointer_ui = UIElement(self.clickable_area, Point(0, 0), Point(0, 0))
@@ -1003,7 +1097,7 @@ class Slider(UIElement):
         for i, offset in enumerate(self.offsets):
             if i % 20:
                 continue
-            line = drawing.Quad(globals.ui_buffer)
+            line = drawing.Quad(self.ui_buffer())
             line_bl = (
                 self.clickable_area.absolute.bottom_left
                 + Point(offset, 0.3) * self.clickable_area.absolute.size
@@ -1151,44 +1245,166 @@ class SmoothSlider(Slider):
         self.pointer_quad.set_colour(self.pointer_colour)
 
 
+class ListBoxRow(object):
+    """The two TextBoxes showing one row of a ListBox, and the item they're currently showing"""
+
+    def __init__(self, name, value, item):
+        self.name = name
+        self.value = value
+        self.item = item
+
+    def show(self, item):
+        if item == self.item:
+            return
+        name, value = item
+        if self.item is None or name != self.item[0]:
+            self.name.set_text(name)
+        if self.item is None or value != self.item[1]:
+            self.value.set_text("%s" % value)
+        self.item = item
+
+    def set_pos(self, y):
+        self.name.set_pos(Point(self.name.bottom_left.x, y))
+        self.value.set_pos(Point(self.value.bottom_left.x, y))
+
+    def enable(self):
+        self.name.enable()
+        self.value.enable()
+
+    def disable(self):
+        self.name.disable()
+        self.value.disable()
+
+    def delete(self):
+        for box in self.name, self.value:
+            box.delete()
+            box.parent.remove_child(box)
+
+
 class ListBox(UIElement):
+    """
+    A list of (name, value) pairs. The items are only kept as data, and there are only ever TextBoxes for the
+    rows that are actually in the box. Scrolling hands the rows that fall off one end to the ones coming on at
+    the other, so a list of thousands of entries costs no more to have around than one that fits
+    """
+
     def __init__(self, parent, bl, tr, text_size, items):
         super(ListBox, self).__init__(parent, bl, tr)
         self.text_size = text_size
+        self.text_manager = globals.text_manager
+        self.items = []
+        self.first = 0
+        # Index of item -> the ListBoxRow showing it
+        self.rows = {}
+        self.spare = []
+        self.geometry = None
         self.update_items(items)
+        self.enable()
+
+    def measure(self):
+        """
+        Work out how tall a row is and where the value column starts, both relative to us. The TextBoxes keep
+        a 0.05 margin on each side, so they need to be a bit bigger than the text itself
+        """
+        text_height = self.text_manager.font_height * self.text_size * drawing.texture.global_scale
+        row_height = text_height / 0.9 / self.absolute.size.y
+        widths = [self.text_manager.get_size(name, self.text_size).x for name, value in self.items if name]
+        name_width = max(widths, default=0) / 0.9 / self.absolute.size.x
+        return row_height, 0.02 + name_width + 0.02
+
+    @property
+    def num_rows(self):
+        return max(1, int(1 / self.geometry[0]))
+
+    def row_y(self, index):
+        return 1 - self.geometry[0] * (index - self.first + 1)
+
+    def valid_first(self, first):
+        return max(0, min(first, len(self.items) - self.num_rows))
 
     def update_items(self, items):
-        # This is a massive hack, using hardcoded values, and generally being shit. I'm bored of UI things now
-        enabled = self.enabled
-        self.delete()
-        if enabled:
-            self.enable()
-        self.children = []
-        self.items = items
-        height = 0.8
-        maxx = 0
-
-        for name, value in self.items:
-            t = TextBox(parent=self, bl=Point(0.05, height), tr=None, text=name, scale=self.text_size)
-            height -= t.size.y
-            if t.top_right.x > maxx:
-                maxx = t.top_right.x
-            if not self.enabled:
-                t.disable()
-
-        last_height = height = 0.8
-        for i, (name, value) in enumerate(self.items):
-            if i == len(self.items) - 1:
-                bl = Point(maxx + 0.02, 0)
-                tr = Point(1, last_height)
-            else:
-                bl = Point(maxx + 0.05, height)
-                tr = None
-            t = TextBox(parent=self, bl=bl, tr=tr, text="%s" % value, scale=self.text_size)
-            if not self.enabled:
-                t.disable()
-            last_height = height
-            height -= t.size.y
+        """Change the whole list. Only the rows on screen whose item has actually changed get touched"""
+        self.items = list(items)
+        self.check_geometry()
+        self.refresh()
+
+    def set_item(self, index, item):
+        """Change a single item"""
+        self.items[index] = item
+        if index in self.rows:
+            self.rows[index].show(item)
+
+    def check_geometry(self):
+        geometry = self.measure()
+        if geometry != self.geometry:
+            # Everything has a different size, so start again from scratch
+            self.geometry = geometry
+            for row in list(self.rows.values()) + self.spare:
+                row.delete()
+            self.rows = {}
+            self.spare = []
+        self.first = self.valid_first(self.first)
+
+    def refresh(self):
+        """Make the rows in the box match the items that should be in it"""
+        visible = range(self.first, min(self.first + self.num_rows, len(self.items)))
+        for index in [index for index in self.rows if index not in visible]:
+            row = self.rows.pop(index)
+            row.disable()
+            self.spare.append(row)
+
+        for index in visible:
+            row = self.rows.get(index)
+            if row is None:
+                row = self.new_row(index)
+                self.rows[index] = row
+            row.show(self.items[index])
+
+    def new_row(self, index):
+        y = self.row_y(index)
+        if self.spare:
+            row = self.spare.pop()
+            row.set_pos(y)
+            if self.enabled:
+                row.enable()
+            return row
+
+        row_height, name_width = self.geometry
+        name, value = self.items[index]
+        row = ListBoxRow(
+            TextBox(self, Point(0.02, y), Point(name_width, y + row_height), name, self.text_size),
+            TextBox(self, Point(name_width, y), Point(1, y + row_height), "%s" % value, self.text_size),
+            self.items[index],
+        )
+        if not self.enabled:
+            row.disable()
+        return row
+
+    def scroll(self, amount):
+        first = self.valid_first(self.first - amount)
+        if first != self.first:
+            self.first = first
+            for index, row in self.rows.items():
+                row.set_pos(self.row_y(index))
+            self.refresh()
+
+    def update_layout(self):
+        super(ListBox, self).update_layout()
+        self.check_geometry()
+        self.refresh()
+
+    def enable(self):
+        if not self.enabled:
+            self.root.register_ui_element(self)
+            for row in self.rows.values():
+                row.enable()
+        self.enabled = True
+
+    def disable(self):
+        if self.enabled:
+            self.root.remove_ui_element(self)
+        # The spare rows are already disabled, so this is just the ones in use
+        super(ListBox, self).disable()
 
 
 class TabPage(UIElement):
@@ -1409,9 +1625,9 @@ class DepressButton(ImageButtonBase):
 
 class Border(UIElement):
     def __init__(self, parent, pos, tr, colour, line_width=1, buffer=None):
-        if buffer is None:
-            buffer = globals.ui_buffer
         super(Border, self).__init__(parent, pos, tr)
+        if buffer is None:
+            buffer = self.ui_buffer()
         self.border = drawing.QuadBorder(buffer, line_width=line_width)
         self.colour = colour
         self.border.set_colour(colour)
@@ -1419,8 +1635,8 @@ class Border(UIElement):
         self.border.set_vertices(self.absolute.bottom_left, self.absolute.top_right)
         self.enable()
 
-    def update_position(self):
-        super(Border, self).UpdatePosition()
+    def update_layout(self):
+        super(Border, self).update_layout()
         self.border.set_vertices(self.absolute.bottom_left, self.absolute.top_right)
 
     def delete(self):